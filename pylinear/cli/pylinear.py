@@ -126,8 +126,16 @@ def extract():
                                        mskbeams=conf['mskbeams'],
                                        usehdf5=conf['usehdf5'],
                                        matrix_path=conf['matpath'],
+                                       cachesize=conf['cachesize'],
+                                       codec=conf['codec'],
                                        grpfile=grpfile,group=conf['group'],
-                                       ncpu=conf['ncpu'])
+                                       ncpu=conf['ncpu'],
+                                       precision=conf['precision'],
+                                       warmstart=conf['warmstart'],
+                                       precondition=conf['precondition'],
+                                       outofcore=conf['outofcore'],
+                                       flatdwav=conf['flatdwav'],
+                                       matncpu=conf['matncpu'])
 def extract_fluxcube():
     print('[info]Running pyLINEAR Extract_Fluxcube')
     conf=pylinear.Config()
@@ -192,7 +192,9 @@ class Config(object):
     # these variables specify which keywords belong to which modules
     _extract1d=['segfile','obslst','imglst','detindex','path','remake',
                 'inverter',
-                'method','logdamp','usehdf5','hdf5file','ncpu','nsub']
+                'method','logdamp','usehdf5','hdf5file','ncpu','nsub',
+                'cachesize','codec','precision','warmstart','precondition',
+                'outofcore','flatdwav','matncpu']
     
 
     # will add noise and background properties
@@ -222,7 +224,7 @@ class Config(object):
             cls.cfg['path']=Keyword('path','tables','relative path to where tables',write=True)
             cls.cfg['gzip']=Keyword('gzip',True,'gzip output products')
             cls.cfg['remake']=Keyword('remake',False,'flag to force remaking the tables')
-            cls.cfg['inverter']=Keyword('inverter','lsqr','method for inverting the matrix',choices=['lsqr','lsmr'])
+            cls.cfg['inverter']=Keyword('inverter','lsqr','method for inverting the matrix',choices=['lsqr','lsmr','gkb'])
             cls.cfg['method']=Keyword('method','golden','method for optimizing regularization',choices=['grid','golden','single'])
             cls.cfg['logdamp']=Keyword('logdamp',[-5.,-1.,0.1],'log-damping values')
             cls.cfg['beams']=Keyword('beams',['+1'],'beams to process')
@@ -231,12 +233,20 @@ class Config(object):
             cls.cfg['grpfile']=Keyword('grpfile','','group file to use')
             cls.cfg['root']=Keyword('root','pylinear','output files start with this name')
             #cls.cfg['wrmatrix']=Keyword('wrmatrix',True,'flag to write the HDF5 matrix files')
-            cls.cfg['usehdf5']=Keyword('usehdf5',False,'flag to load from HDF5 matrix files')
+            cls.cfg['usehdf5']=Keyword('usehdf5',True,'flag to reuse cached HDF5 matrix files')
             cls.cfg['matpath']=Keyword('matpath','matrices','Path where matrices are stored')
+            cls.cfg['cachesize']=Keyword('cachesize',10.,'max size of the matrix cache in GB (0=no limit)')
+            cls.cfg['codec']=Keyword('codec','lzf','compression of the matrix files',choices=['lzf','gzip','none'])
+            cls.cfg['warmstart']=Keyword('warmstart',False,'flag to warm start the damping search')
+            cls.cfg['precondition']=Keyword('precondition',False,'flag to equilibrate the (damped) matrix columns')
+            cls.cfg['outofcore']=Keyword('outofcore',False,'flag to keep the matrix on disk')
+            cls.cfg['flatdwav']=Keyword('flatdwav',0.,'wavelength step (A) to tabulate chromatic flats (0=exact); costs 4 bytes per pixel per step, capped at 512 MB')
+            cls.cfg['precision']=Keyword('precision','double','precision of the matrix elements',choices=['double','single'])
             cls.cfg['cubeid']=Keyword('cubeid',1,'SegID for flux-cube extraction')
             
             # things that probably shouldn't be fiddled with
             cls.cfg['ncpu']=Keyword('ncpu',0,'number of CPU to use (0=optimize)')
+            cls.cfg['matncpu']=Keyword('matncpu',1,'number of CPU to build a matrix (0=optimize)')
             cls.cfg['nsub']=Keyword('nsub',10,'wavelength subsampling rate')
 
             
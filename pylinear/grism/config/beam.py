@@ -1,15 +1,17 @@
 import os
+import copy
 from astropy.io import fits
 import numpy as np
 import polyclip
 from .flatfield import UnityFlatField,ImageFlatField
+from .filecache import file_key,freeze
 
 
 class Spatial(object):
     def __init__(self,values):
         if np.isscalar(values):
             self.order=0
-            self.coefs=[((0,0),values)]
+            self.coefs=[(values,(0,0))]
         else:
             n=(np.sqrt(1+8*len(values))-1)/2
             N=int(n)
@@ -19,22 +21,34 @@ class Spatial(object):
             self.coefs=list(zip(values,powers))
             self.order=N-1
 
+        # pack the coefficients into a matrix for array-level evaluation
+        cmat=np.zeros((self.order+1,self.order+1),dtype=float)
+        for coef,(i,j) in self.coefs:
+            cmat[i,j]=coef
+        self.cmat=freeze(cmat)
+            
     def __str__(self):
         return 'Spatial polynomial of order = {}'.format(self.order)
             
     def evaluate(self,xy):
-        ''' evaluate the 2d polynomial at a scalar position (x,y) '''
+        ''' evaluate the 2d polynomial at position(s) (x,y) '''
 
-        return sum(coef*xy[0]**i*xy[1]**j for coef,(i,j) in self.coefs)
+        x=np.asarray(xy[0],dtype=float)
+        y=np.asarray(xy[1],dtype=float)
+        return np.polynomial.polynomial.polyval2d(x,y,self.cmat)
 
 
 class Parametric(object):
-    def __init__(self,name):
+    def __init__(self,name,niter=20,tol=1e-10,trange=None):
         self.name=name
         self.polys=[]
         self.order=-1
         self.inverse_function=None
 
+        # settings for the numerical inversion
+        self.niter=niter        # max number of Halley iterations
+        self.tol=tol            # relative tolerance on the parameter
+        self.trange=trange      # optional (min,max) bracket on parameter
 
         
     def append(self,p):
@@ -49,17 +63,73 @@ class Parametric(object):
             self.inverse_function=self._nth
             
             
-    def _first(self,f,coefs):
+    def _first(self,f,coefs,**kwargs):
         ''' analytically invert a 1st order polynomial '''
         return (f-coefs[0])/coefs[1]        
 
-    def _second(self,f,coefs):
+    def _second(self,f,coefs,**kwargs):
         ''' analytically invert a 2nd order polynomial '''
-        raise NotImplementedError    
 
-    def _nth(self,f,coefs):
+        a=coefs[2]
+        b=coefs[1]
+        c=coefs[0]-f
+        disc=b*b-4*a*c
+
+        # use the numerically-stable root, which is the one that tends
+        # to the linear solution as the quadratic term goes to zero
+        with np.errstate(divide='ignore',invalid='ignore'):
+            sgn=np.where(b>=0,1.,-1.)
+            q=-0.5*(b+sgn*np.sqrt(np.maximum(disc,0.)))
+            t=np.where(disc>=0,c/q,np.nan)
+        return t
+
+    def _nth(self,f,coefs,niter=None,**kwargs):
         ''' numerically invert an arbitrary order polynomial '''
-        raise NotImplementedError
+
+        if niter is None:
+            niter=self.niter
+        
+        # initial guess from the linear terms, which has the
+        # broadcasted shape of all the inputs (ie. (nwav,nvertex))
+        shape=np.broadcast(f,*coefs).shape
+        t=np.array(np.broadcast_to(self._first(f,coefs),shape),dtype=float)
+
+        # the bracket on the root, which gets tightened as we iterate
+        lo=np.full(shape,-np.inf)
+        hi=np.full(shape,+np.inf)
+        if self.trange is not None:
+            lo[:]=self.trange[0]
+            hi[:]=self.trange[1]
+            t=np.clip(t,lo,hi)
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            for itn in range(niter):
+                # evaluate the polynomial and derivatives with Horner's rule
+                p,dp,d2p=coefs[-1],0.,0.
+                for coef in reversed(coefs[:-1]):
+                    d2p=d2p*t+2*dp
+                    dp=dp*t+p
+                    p=p*t+coef
+                r=p-f
+                
+                # update the bracket
+                ahead=(r*dp)<0
+                lo=np.where(ahead,np.maximum(lo,t),lo)
+                hi=np.where(ahead,hi,np.minimum(hi,t))
+
+                # take a Halley step, but bisect if it leaves the bracket
+                tnew=t-(2*r*dp)/(2*dp*dp-r*d2p)
+                bad=~((tnew>lo) & (tnew<hi))
+                bisect=bad & np.isfinite(lo) & np.isfinite(hi)
+                tnew=np.where(bisect,0.5*(lo+hi),tnew)
+                tnew=np.where(bad & ~bisect,t-r/dp,tnew)
+
+                # test for convergence
+                done=np.abs(tnew-t)<=self.tol*(1.+np.abs(t))
+                t=tnew
+                if np.all(done | ~np.isfinite(t)):
+                    break
+        return t
     
     def __len__(self):
         ''' return the number of terms (N=order-1) '''
@@ -79,18 +149,25 @@ class Parametric(object):
     def evaluate(self,xy,t):
         ''' evaluate the polynomial at some position (x,y) and parameter '''
 
-        f=sum(poly.evaluate(xy)*t**i for i,poly in enumerate(self.polys))
+        # Horner's rule, which broadcasts a (nvertex,) set of positions
+        # against a (nwav,nvertex) set of parameters
+        f=0.
+        for poly in reversed(self.polys):
+            f=f*t+poly.evaluate(xy)
         return f
 
-    def invert(self,xy,f):
+    def invert(self,xy,f,niter=None):
         ''' invert the polynomial at some position (x,y) and function value '''
 
         coefs=[poly.evaluate(xy) for poly in self.polys]
-        t=self.inverse_function(f,coefs)
+        t=self.inverse_function(f,coefs,niter=niter)
         return t
         
       
 class Sensitivity(object):
+    # the sensitivity curves that are loaded, keyed by the file
+    CACHE={}
+    
     def __init__(self,sensfile,senslimit=1e14):
         self.sensfile=sensfile
         
@@ -98,10 +175,10 @@ class Sensitivity(object):
         with fits.open(self.sensfile) as f:
             data=f[1].data
             
-        # save the data
-        self.sensitivity=data['SENSITIVITY']
-        self.wavelength=data['WAVELENGTH']
-        self.error=data['ERROR']
+            # save the data (which are shared, so are read-only)
+            self.sensitivity=freeze(data['SENSITIVITY'])
+            self.wavelength=freeze(data['WAVELENGTH'])
+            self.error=freeze(data['ERROR'])
         
         # compute the range
         g=np.where(self.sensitivity > senslimit)
@@ -112,11 +189,21 @@ class Sensitivity(object):
         self.smax=np.amax(self.sensitivity)
 
         
+    @classmethod
+    def load(cls,sensfile,senslimit=1e14):
+        ''' load a sensitivity curve, or reuse one already loaded '''
+        key=(file_key(sensfile),senslimit)
+        if key not in cls.CACHE:
+            cls.CACHE[key]=cls(sensfile,senslimit=senslimit)
+        return cls.CACHE[key]
+    
     def __mul__(self,a):
-        self.sensitivity*=a
-        self.error*=a
-        self.smax*=a
-        return self
+        # the curves are shared, so scaling makes a new curve
+        new=copy.copy(self)
+        new.sensitivity=freeze(self.sensitivity*a)
+        new.error=freeze(self.error*a)
+        new.smax=self.smax*a
+        return new
         
     def __rmul__(self,a):
         return self.__mul__(a)
@@ -131,6 +218,10 @@ class Sensitivity(object):
 
 class Beam(object):
     COMMENTS=['%','#','$','!']
+
+    # the beams that are loaded, keyed by the config file and beam
+    CACHE={}
+    
     def __init__(self,conffile,beam):
         valid=lambda s: (len(s)>0 and not any(map(s.startswith,self.COMMENTS)))
 
@@ -189,7 +280,7 @@ class Beam(object):
                         
                         if key.startswith('SENSITIVITY_{}'.format(beam)):
                             sensfile=os.path.join(path,val[0])
-                            self.sensitivity=Sensitivity(sensfile)
+                            self.sensitivity=Sensitivity.load(sensfile)
 
                         if key.startswith('WEDGE'):
                             filt=key.split('_')[1]
@@ -205,6 +296,25 @@ class Beam(object):
         assert okay,'{} order is not present in the config file.'.format(beam)
 
         
+    @classmethod
+    def load(cls,conffile,beam):
+        ''' load a beam, or reuse one already loaded '''
+        filename=os.path.join(os.environ['PYLINEAR_CONFIG'],conffile)
+        key=(file_key(filename),beam)
+        if key not in cls.CACHE:
+            cls.CACHE[key]=cls(conffile,beam)
+        return cls.CACHE[key]
+
+    def __getstate__(self):
+        # the polygon clipper is rebuilt, rather than pickled
+        state=self.__dict__.copy()
+        state.pop('polyclip',None)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.polyclip=polyclip.Polyclip(self.naxis)
+    
     def __str__(self):
         return "Grism beam for {}".format(self.beam)
         
@@ -218,11 +328,12 @@ class Beam(object):
                 pass
         return v
 
-    def load_flatfield(self,unity=False):        
+    def load_flatfield(self,unity=False,dwav=None):
+        ''' load the flat field, optionally tabulated every dwav (in A) '''
         if unity or not hasattr(self,'ffname'):
             ff=UnityFlatField(np.flip(self.naxis))
         else:
-            ff=ImageFlatField(self.ffname)
+            ff=ImageFlatField.load(self.ffname,dwav=dwav)
         return ff
     
     def dispersion(self,xy):
@@ -248,14 +359,16 @@ class Beam(object):
 
 
     def disperse(self,xd,yd,wav,band=None):
-        nx=len(xd)
-        nw=len(wav)
-        xg=np.empty((nw,nx))
-        yg=np.empty((nw,nx))
-        for i,xyd in enumerate(zip(xd,yd)):
-            t=self.displ.invert(xyd,wav)
-            xg[:,i]=self.dispx.evaluate(xyd,t)+xyd[0]
-            yg[:,i]=self.dispy.evaluate(xyd,t)+xyd[1]
+        ''' disperse a set of vertices, returns (nwav,nvertex) arrays '''
+        
+        xd=np.asarray(xd,dtype=float)
+        yd=np.asarray(yd,dtype=float)
+        xyd=(xd,yd)
+
+        # evaluate the trace for every vertex and wavelength at once
+        t=self.displ.invert(xyd,np.asarray(wav,dtype=float)[:,np.newaxis])
+        xg=self.dispx.evaluate(xyd,t)+xd
+        yg=self.dispy.evaluate(xyd,t)+yd
 
         # implement the wedge offset
         if band is not None and band in self.wedge:
@@ -265,53 +378,72 @@ class Beam(object):
             
         return xg,yg
 
-    def drizzle(self,xd,yd,wav,ignore='average',pixfrac=1.,band=None):
-        assert np.isclose(pixfrac,1.,atol=1e-3),'pixfrac must be 1.0'
+    def in_range(self,xd,yd,ignore='average'):
+        ''' test which pixels (rows of vertices) are in the bounding box '''
+
+        keep=np.ones(len(xd),dtype=bool)
         
         # apply the ignoring procedure
         if hasattr(self,'xr') and hasattr(self,'yr'):
             ignore=ignore.lower()
             if ignore=='average':
                 # if average of pixel is in bounding box
-                xave=np.average(xd)
-                yave=np.average(yd)
-                if (xave<self.xr[0]) or (xave>self.xr[1]) or \
-                   (yave<self.yr[0]) or (yave>self.yr[1]):
-                    return [],[],[],[]
+                xave=np.average(xd,axis=1)
+                yave=np.average(yd,axis=1)
+                keep=(xave>=self.xr[0]) & (xave<=self.xr[1]) & \
+                    (yave>=self.yr[0]) & (yave<=self.yr[1])
             elif ignore=='minmax':
                 # test min/max in range
-                x0,x1=np.amin(xd),np.amax(xd)
-                y0,y1=np.amin(yd),np.amax(yd) 
-                if (x1<self.xr[0]) or (x0>self.xr[1]) or \
-                   (y1<self.yr[0]) or (y0>self.yr[1]):
-                    return [],[],[],[]
+                x0,x1=np.amin(xd,axis=1),np.amax(xd,axis=1)
+                y0,y1=np.amin(yd,axis=1),np.amax(yd,axis=1) 
+                keep=(x1>=self.xr[0]) & (x0<=self.xr[1]) & \
+                    (y1>=self.yr[0]) & (y0<=self.yr[1])
             else:
                 pass
+        return keep
+        
+    def drizzle(self,xd,yd,wav,ignore='average',pixfrac=1.,band=None):
+        ''' drizzle a single polygon '''
+        
+        xd=np.asarray(xd,dtype=float)[np.newaxis,:]
+        yd=np.asarray(yd,dtype=float)[np.newaxis,:]
+        pix,x,y,lam,area=self.drizzle_pixels(xd,yd,wav,ignore=ignore,
+                                             pixfrac=pixfrac,band=band)
+        return x,y,lam,area
+
+    def drizzle_pixels(self,xd,yd,wav,ignore='average',pixfrac=1.,band=None):
+        ''' drizzle many polygons, given as (npix,nvertex) arrays '''
         
-        # disperse each polygon vertix
-        xg,yg=self.disperse(xd,yd,wav,band=band)
+        assert np.isclose(pixfrac,1.,atol=1e-3),'pixfrac must be 1.0'
+
+        # only work with the pixels that are in range
+        pix=np.where(self.in_range(xd,yd,ignore=ignore))[0]
+        npix=len(pix)
+        if npix==0:
+            return (np.array([],dtype=int),np.array([],dtype=int),
+                    np.array([],dtype=int),np.array([],dtype=np.uint16),
+                    np.array([],dtype=float))
+        nvert=xd.shape[1]
+        nwav=len(wav)
+        
+        # disperse every polygon vertix at once
+        xg,yg=self.disperse(xd[pix].ravel(),yd[pix].ravel(),wav,band=band)
 
-        # apply clipping
+        # reorder as one polygon per (pixel,wavelength) and apply clipping
+        xg=xg.reshape(nwav,npix,nvert).transpose(1,0,2).reshape(-1,nvert)
+        yg=yg.reshape(nwav,npix,nvert).transpose(1,0,2).reshape(-1,nvert)
         xg=np.clip(xg,0,self.naxis[0])
         yg=np.clip(yg,0,self.naxis[1])
         
         # clip against a pixel grid
         x,y,area,indices=self.polyclip(xg,yg)
 
-        # replicate the wavelength indices
-        n=len(x)
-        if n>0:
-            i0=indices[0:-1]
-            i1=indices[1:]
-            gg=np.where(i1 != i0)[0]
-            lam=np.empty(n,dtype=np.uint16)
-            for g,a,b in zip(gg,i0[gg],i1[gg]):
-                lam[a:b]=g
-        else:
-            lam=[]
-
-               
-        return x,y,lam,area
+        # replicate the polygon indices, and split into pixel/wavelength
+        indices=np.asarray(indices)
+        poly=np.repeat(np.arange(len(indices)-1),np.diff(indices))
+        ipix,lam=np.divmod(poly,nwav)
+        
+        return pix[ipix],x,y,lam.astype(np.uint16),area
 
 
     def sensitivity(self,wav,**kwargs):
@@ -0,0 +1,42 @@
+import os
+import hashlib
+import numpy as np
+
+
+''' Helpers to share objects parsed from the calibration files
+
+The grism configurations, sensitivity curves, and flat fields are parsed
+once per process and shared, so their arrays are made read-only.
+'''
+
+
+# hashes of the contents of the files, keyed by the file
+HASHES={}
+
+
+def file_key(filename):
+    ''' identify a file by its name, modification time, and size '''
+    stat=os.stat(filename)
+    return (filename,stat.st_mtime,stat.st_size)
+
+
+def file_hash(filename):
+    ''' hash the contents of a file (once per version of the file) '''
+    key=file_key(filename)
+    if key not in HASHES:
+        sha=hashlib.sha1()
+        with open(filename,'rb') as fp:
+            for block in iter(lambda: fp.read(2**20),b''):
+                sha.update(block)
+        HASHES[key]=sha.hexdigest()
+    return HASHES[key]
+
+
+def freeze(*arrays):
+    ''' make (copies of) arrays that cannot be modified '''
+    out=[]
+    for array in arrays:
+        array=np.array(array)
+        array.setflags(write=False)
+        out.append(array)
+    return out[0] if len(out)==1 else out
@@ -1,6 +1,8 @@
 from astropy.io import fits
 import numpy as np
 
+from .filecache import file_key,freeze
+
 
 
 ''' Set of classes to implement grism flat fielding
@@ -11,6 +13,10 @@ Written for pyLINEAR by R Ryan
 
 class FlatField(object):
     DTYPE=np.float32
+
+    def prepare(self):
+        ''' precompute anything the lookups need '''
+        pass
     
 class UnityFlatField(FlatField):
     def __init__(self,shape):
@@ -27,42 +33,127 @@ class UnityFlatField(FlatField):
 
     
 class ImageFlatField(FlatField):
-    def __init__(self,filename):
+    # the flat fields that are loaded, keyed by the file (and binning)
+    CACHE={}
+
+    # max size of a tabulated flat field (in bytes)
+    MAXCUBE=2**29
+    
+    def __init__(self,filename,dwav=None):
         self.filename=filename
         with fits.open(self.filename) as hdul:
-            self.data=[hdu.data for hdu in hdul if hdu.data is not None]
+            data=[hdu.data for hdu in hdul if hdu.data is not None]
+            header=hdul[0].header
 
-        self.order=len(self.data)
+        self.order=len(data)
         if self.order ==0:
             # null flat
             print('[warn]Flat-field is invalid, using ones')
+            self.data=[]
             self.ftype='Unity'
             self.func=self.unity
-        elif self.order==1:
+            return
+
+        # the terms are stacked as (ny,nx,order), so all the terms of a
+        # pixel are gathered at once
+        self.coefs=freeze(np.stack(data,axis=-1))
+        self.data=[self.coefs[:,:,i] for i in range(self.order)]
+        self.shape=self.coefs.shape[:2]
+        
+        if self.order==1:
             # gray flat
-            self.shape=self.data[0].shape
             self.ftype='Gray'
             self.func=self.gray
         else:
             # chromatic flat
-            self.shape=self.data[0].shape
-            self.wmin=hdul[0].header['WMIN']
-            self.wmax=hdul[0].header['WMAX']
+            self.wmin=header['WMIN']
+            self.wmax=header['WMAX']
             self.ftype='Polynomial'
             self.func=self.poly
-        
+
+            # the flat is tabulated every dwav (in A), which is built
+            # when first used.  The error of the interpolation is about
+            # dwav**2/8 times the curvature of the flat in wavelength
+            self.dwav=dwav if dwav else None
+            self.cube=None
+            
             
 
+    @classmethod
+    def load(cls,filename,dwav=None):
+        ''' load a flat field, or reuse one already loaded '''
+        key=(file_key(filename),dwav if dwav else None)
+        if key not in cls.CACHE:
+            cls.CACHE[key]=cls(filename,dwav=dwav)
+        return cls.CACHE[key]
+    
     def __str__(self):
         s='{} Flat Field'.format(self.ftype)
         if self.ftype =='Polynomial':
             s+=' with {} terms'.format(self.order)
+            if self.dwav is not None:
+                s+=' (tabulated every {} A)'.format(self.dwav)
         return s
 
+    def horner(self,c,ll):
+        ''' evaluate the polynomial of the (stacked) terms '''
+        ff=np.array(c[...,-1],dtype=np.float64)
+        for i in range(self.order-2,-1,-1):
+            ff*=ll
+            ff+=c[...,i]
+        return ff
+            
+    def prepare(self):
+        ''' tabulate the flat field now (say before forking workers, which
+            then share it), rather than when first used '''
+        if self.ftype=='Polynomial' and self.dwav is not None and \
+           self.cube is None:
+            self.make_cube()
             
+    def make_cube(self):
+        ''' tabulate the flat field on a grid of wavelengths '''
+        nwav=max(int(np.ceil((self.wmax-self.wmin)/self.dwav)),1)+1
+
+        # the cube has 4 bytes per pixel and wavelength, so is capped
+        size=np.dtype(self.DTYPE).itemsize*self.shape[0]*self.shape[1]
+        if nwav*size > self.MAXCUBE:
+            nwav=max(self.MAXCUBE//size,2)
+            self.dwav=(self.wmax-self.wmin)/(nwav-1)
+            print('[warn]Tabulated flat field is too large, using a '+\
+                  'step of {:.1f} A'.format(self.dwav))
+        self.cwav=np.linspace(self.wmin,self.wmax,nwav)
+        print('[info]Tabulating the flat field at {} wavelengths ({:.0f} MB)'.
+              format(nwav,nwav*size/2.**20))
+        cube=np.empty(self.shape+(nwav,),dtype=self.DTYPE)
+        ll=(self.cwav-self.wmin)/(self.wmax-self.wmin)
+        for k,lk in enumerate(ll):
+            cube[:,:,k]=self.horner(self.coefs,lk)
+        cube.setflags(write=False)
+        self.cube=cube
+        
     def poly(self,x,y,l):
         ll=(l-self.wmin)/(self.wmax-self.wmin)
-        ff=sum(datum[y,x]*ll**i for i,datum in enumerate(self.data))
+        if self.dwav is None:
+            return self.horner(self.coefs[y,x],ll)
+
+        # interpolate the tabulated flat, but evaluate the polynomial
+        # beyond the tabulated range
+        if self.cube is None:
+            self.make_cube()
+        nwav=len(self.cwav)
+        t=ll*(nwav-1)
+        g=(t>=0) & (t<=nwav-1)
+        k=np.clip(t.astype(np.int64),0,nwav-2)
+        t-=k
+
+        # the neighboring wavelengths are adjacent in memory
+        i=(y.astype(np.int64)*self.shape[1]+x)*nwav+k
+        cube=self.cube.ravel()
+        lo=cube.take(i)
+        ff=lo+t*(cube.take(i+1)-lo)
+        if not np.all(g):
+            b=np.where(~g)[0]
+            ff[b]=self.horner(self.coefs[y[b],x[b]],ll[b])
         return ff
 
     def gray(self,x,y,l):
@@ -0,0 +1,116 @@
+import os
+import glob
+import gzip
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+from astropy.io import fits
+
+
+class ExposureReader(object):
+    ''' open each exposure once, and serve memory-mapped extensions '''
+
+    # max number of files that are kept open
+    MAXOPEN=16
+
+    # where gzipped files are decompressed (None is the system default)
+    SCRATCH=None
+
+    # the open files (keyed by path), in order of use
+    FILES=OrderedDict()
+
+    @staticmethod
+    def stamp(filename):
+        stat=os.stat(filename)
+        return (stat.st_mtime_ns,stat.st_size)
+
+    @classmethod
+    def scratch_path(cls):
+        if cls.SCRATCH:
+            path=cls.SCRATCH
+        else:
+            path=os.path.join(tempfile.gettempdir(),'pylinear_exposures')
+        if not os.path.isdir(path):
+            os.makedirs(path,exist_ok=True)
+        return path
+
+    @classmethod
+    def decompress(cls,filename):
+        ''' decompress a file to the scratch path (once) '''
+
+        key=str((os.path.abspath(filename),cls.stamp(filename)))
+        key=hashlib.sha1(key.encode()).hexdigest()[:16]
+        base=os.path.basename(filename)[:-len('.gz')]
+        outfile=os.path.join(cls.scratch_path(),'{}_{}'.format(key,base))
+        if not os.path.isfile(outfile):
+            print('[info]Decompressing {}'.format(filename))
+            stale=glob.glob(os.path.join(cls.scratch_path(),'?'*16+'_'+base))
+            tmpfile='{}.{}.tmp'.format(outfile,os.getpid())
+            with gzip.open(filename,'rb') as fin,open(tmpfile,'wb') as fout:
+                shutil.copyfileobj(fin,fout)
+            os.replace(tmpfile,outfile)
+
+            # remove the copies of older versions of the file
+            for f in stale:
+                if f!=outfile and os.path.isfile(f):
+                    os.remove(f)
+        return outfile
+
+    @classmethod
+    def open(cls,filename):
+        ''' the (memory-mapped) HDUList of a file '''
+
+        path=os.path.abspath(filename)
+        stamp=cls.stamp(filename)
+        if path in cls.FILES:
+            oldstamp,hdul=cls.FILES.pop(path)
+            if oldstamp==stamp:
+                cls.FILES[path]=(stamp,hdul)
+                return hdul
+            hdul.close()      # the file changed, so reopen it
+
+        # close the least-recently used files
+        while len(cls.FILES)>=max(cls.MAXOPEN,1):
+            oldpath,(oldstamp,oldhdul)=cls.FILES.popitem(last=False)
+            oldhdul.close()
+
+        if filename.endswith('.gz'):
+            local=cls.decompress(filename)
+        else:
+            local=filename
+        hdul=fits.open(local,mode='readonly',memmap=True)
+        cls.FILES[path]=(stamp,hdul)
+        return hdul
+
+    @classmethod
+    def getheader(cls,filename,ext=0):
+        ''' a copy of a header, which may be modified '''
+        return cls.open(filename)[ext].header.copy()
+
+    @classmethod
+    def getdata(cls,filename,ext=0):
+        ''' a read-only view of the data of an extension '''
+
+        # the data are shared by all the stages, so cannot be modified
+        data=cls.open(filename)[ext].data
+        if data is not None:
+            data.setflags(write=False)
+        return data
+
+    @classmethod
+    def read(cls,filename,ext=0):
+        return cls.getdata(filename,ext=ext),cls.getheader(filename,ext=ext)
+
+    @classmethod
+    def close(cls,filename=None):
+        ''' close a file (or all the files) '''
+
+        if filename is None:
+            paths=list(cls.FILES.keys())
+        else:
+            paths=[os.path.abspath(filename)]
+        for path in paths:
+            if path in cls.FILES:
+                stamp,hdul=cls.FILES.pop(path)
+                hdul.close()
@@ -4,6 +4,7 @@ import os
 
 from ..wcs import WCS
 from .config import Beam
+from .exposure import ExposureReader
 
 class GrismFile(object):
     TYPE=''
@@ -30,7 +31,7 @@ class GrismFile(object):
 
 
     def primary_header(self):
-        hdr = fits.getheader(self.filename,0)
+        hdr = ExposureReader.getheader(self.filename,0)
         return hdr
 
     
@@ -65,7 +66,7 @@ class GrismImage(WCS):
 
         
     def load_beam(self,beam):
-        return Beam(self.conffile,beam)
+        return Beam.load(self.conffile,beam)
 
     
 class SimulatedFile(GrismFile):
@@ -159,7 +160,7 @@ class ObservedFile(GrismFile):
         self.name=filename
         
         # get the primary header
-        phdr=fits.getheader(self.name,ext=0)
+        phdr=ExposureReader.getheader(self.name,ext=0)
 
         # load the observational configuration and detector
         #obsconf=(phdr['TELESCOP'],phdr['INSTRUME'],phdr['DETECTOR'])
@@ -204,13 +205,13 @@ class ObservedImage(GrismImage):
         self.filename=filename
         ext=(device.extensions['science'].extname,
              device.extensions['science'].extver)
-        hdr=fits.getheader(self.filename,ext=ext)
+        hdr=ExposureReader.getheader(self.filename,ext=ext)
         GrismImage.__init__(self,hdr,device,grism)
 
     def readfits(self,exten):
+        ''' a read-only view of an extension, and a copy of its header '''
         ext=(exten.extname,exten.extver)
-        hdr=fits.getheader(self.filename,ext=ext)
-        img=fits.getdata(self.filename,ext=ext)
+        img,hdr=ExposureReader.read(self.filename,ext=ext)
         return img,hdr
     
     def load_science(self):
@@ -5,6 +5,7 @@ import statistics as stats
 from . import instruments
 from ..utilities.ascii_files import read_ascii_table
 from .grism import SimulatedFile,ObservedFile
+from .exposure import ExposureReader
 
 class GrismCollection(object):
     def __init__(self,filename,observed=True):
@@ -90,7 +91,7 @@ class GrismCollection(object):
         
         # interpret each line as a new image
         for (filename,) in tab.iterrows():
-            phdr=fits.getheader(filename,exten=0)
+            phdr=ExposureReader.getheader(filename,ext=0)
 
 
             # let's check the obstype, but assume the best of the user
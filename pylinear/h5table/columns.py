@@ -5,44 +5,102 @@ import numpy as np
 ''' to define the potential columns in the tables WAV, XYG, etc... '''
 
 
-class Column(list):
+class Column(object):
+    ''' a typed array buffer that grows with amortized doubling '''
+
+    # smallest buffer to allocate
+    MINSIZE=16
+    
     def __init__(self,*args,desc=None,dtype=None):
         self.description=desc
         self.dtype=dtype
+        self.clear()
         if len(args)==1:
             self.extend(args[0])
            
+    def clear(self):
+        # allocate a new buffer, so views of the old data remain valid
+        self.n=0
+        self.data=np.zeros(0,dtype=self.dtype)
         
     def reset(self,*args):
+        self.clear()
         if len(args)==1:
-            self=list(args[0])
+            self.extend(args[0])
+
+    def reserve(self,size):
+        ''' grow the buffer to hold at least size elements '''
+        if size>len(self.data):
+            size=max(size,2*len(self.data),self.MINSIZE)
+            data=np.zeros(size,dtype=self.data.dtype)
+            data[:self.n]=self.data[:self.n]
+            self.data=data
+            
+    def extend(self,values):
+        values=np.asarray(values).ravel()
+        if self.dtype is None:
+            if self.n==0:
+                self.data=np.zeros(0,dtype=values.dtype)
         else:
-            self.clear()
+            values=values.astype(self.dtype,copy=False)
+        n=self.n+len(values)
+        self.reserve(n)
+        self.data[self.n:n]=values
+        self.n=n
+
+    def append(self,value):
+        self.extend([value])
+        
+    @property
+    def view(self):
+        ''' a view of the data, which is only valid until the next change '''
+        return self.data[:self.n]
+        
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        yield from self.view
+
+    def __getitem__(self,g):
+        return self.view[g]
+
+    def __setitem__(self,g,v):
+        self.view[g]=v
+        
+    def __array__(self,dtype=None,copy=None):
+        if dtype is None:
+            return self.view
+        return self.view.astype(dtype)
+        
+    def __str__(self):
+        return str(self.view)
 
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,self.view)
+    
     def __ge__(self,a):
-        return self.to_numpy() >= a
+        return self.view >= a
 
     def __gt__(self,a):
-        return self.to_numpy() > a
+        return self.view > a
 
     def __le__(self,a):
-        return self.to_numpy() <= a
+        return self.view <= a
   
     def __lt__(self,a):
-        return self.to_numpy() < a
+        return self.view < a
         
         
     def __imul__(self,a):
-        v=self.to_numpy()*a
-        self.clear()
-        self.extend(v)
+        v=self.view
+        np.multiply(v,a,out=v,casting='unsafe')
         return self
 
 
     def __itruediv__(self,a):
-        v=self.to_numpy()/a
-        self.clear()
-        self.extend(v)
+        v=self.view
+        np.true_divide(v,a,out=v,casting='unsafe')
         return self
     
     
@@ -52,17 +110,18 @@ class Column(list):
         return self.__class__.__name__.lower()
 
     def to_numpy(self,g=None):
-        v=np.array(self,dtype=self.dtype)
+        ''' a copy of the data (optionally for some indices) '''
+        v=self.view
         if g is not None:
-            v=v[g]
-        return v
+            return np.array(v[g],dtype=self.data.dtype)
+        return v.copy()
        
     def astype(self,dtype):
-        return np.array(self,dtype=dtype)
+        return self.view.astype(dtype)
 
 class X(Column):
     def __init__(self,*args,description='x coordinate',dtype=np.uint16):
-        Column.__init__(self,args,desc=description,dtype=dtype)
+        Column.__init__(self,*args,desc=description,dtype=dtype)
 
 class Y(Column):
     def __init__(self,*args,description='y coordinate',dtype=np.uint16):
@@ -3,12 +3,28 @@ import numpy as np
 import os
 
 from .h5tablebase import H5TableBase
+from ..constants import SEGTYPE,COMPARGS
 
 from .pdt import PDT
 from .odt import ODT
 from .omt import OMT
 
 class H5Table(H5TableBase):
+    # number of rows in a chunk of the columnar PDT datasets
+    CHUNKSIZE=2**16
+
+    # data types of the columnar PDT datasets
+    PDTDATA=[('x',np.uint16),('y',np.uint16),('lam',np.uint16),
+             ('val',np.float64)]
+    PDTPIXELS=[('x',np.uint16),('y',np.uint16),('start',np.uint64),
+               ('count',np.uint32)]
+    PDTSOURCES=[('segid',SEGTYPE),('start',np.uint64),('count',np.uint32)]
+
+    # the datasets of the columnar PDTs (anything else is the older layout)
+    PDTNAMES=('data','pixels','sources','fingerprints')
+
+    # fraction of the file that is stale before it is rewritten
+    MAXSTALE=0.25
 
     def __init__(self,dataset,path=None,mode='a'):
         self.dataset=dataset
@@ -21,6 +37,9 @@ class H5Table(H5TableBase):
             raise NotImplementedError('invalid mode {}'.format(mode))
         self.mode=mode
 
+        # cache of the source index of the columnar PDTs
+        self.pdtsources={}
+
 
     def add_device(self,dev,**kwargs):
         self.h5device=self.h5file.require_group(dev.name)
@@ -44,6 +63,235 @@ class H5Table(H5TableBase):
         self.h5beam=self.h5device[beamname]
         self.h5table=self.h5beam[ttype]
         
+    def load_fingerprints(self):
+        ''' load the hashes of the table inputs for each source '''
+        
+        if 'fingerprints' not in self.h5table:
+            return {}
+        data=self.h5table['fingerprints'][:]
+        return {s:h.decode('UTF-8') for s,h in zip(data['segid'],data['hash'])}
+
+    def write_fingerprints(self,fingerprints):
+        ''' write the hashes of the table inputs for each source '''
+        
+        dtype=[('segid',SEGTYPE),('hash','S40')]
+        data=np.array(list(fingerprints.items()),dtype=dtype)
+        if 'fingerprints' in self.h5table:
+            del self.h5table['fingerprints']
+        self.h5table.create_dataset('fingerprints',data=data)
+        
+    def append_data(self,name,data,group=None):
+        ''' append rows to a resizable dataset and return the first row '''
+
+        group=self.h5table if group is None else group
+        if name in group:
+            hd=group[name]
+        else:
+            hd=group.create_dataset(name,shape=(0,),dtype=data.dtype,
+                                    maxshape=(None,),
+                                    chunks=(self.CHUNKSIZE,),
+                                    **COMPARGS)
+        start=hd.shape[0]
+        if len(data)>0:
+            hd.resize((start+len(data),))
+            hd[start:]=data
+        return start
+        
+    def clear_pdts(self):
+        ''' remove all the PDTs in the columnar layout '''
+        
+        for name in ('data','pixels','sources'):
+            if name in self.h5table:
+                del self.h5table[name]
+        self.pdtsources.pop(self.h5table.name,None)
+                
+    def write_pdts(self,segid,pdts):
+        ''' write all the PDTs of a source in the columnar layout '''
+
+        # collect the pixel index and the data
+        pixels=np.zeros(len(pdts),dtype=self.PDTPIXELS)
+        data=np.zeros(sum(len(pdt) for pdt in pdts),dtype=self.PDTDATA)
+        start=0
+        for i,pdt in enumerate(pdts):
+            n=len(pdt)
+            pixels[i]=(pdt.pixel[0],pdt.pixel[1],start,n)
+            data['x'][start:start+n]=pdt.x
+            data['y'][start:start+n]=pdt.y
+            data['lam'][start:start+n]=pdt.lam
+            data['val'][start:start+n]=pdt.val
+            start+=n
+
+        # append to the file with the offsets into the data
+        pixels['start']+=np.uint64(self.append_data('data',data))
+        start=self.append_data('pixels',pixels)
+
+        # record the source.  Rewritten sources append a new entry
+        # and the last entry is the valid one
+        sources=np.array([(segid,start,len(pixels))],dtype=self.PDTSOURCES)
+        self.append_data('sources',sources)
+        self.pdtsources.pop(self.h5table.name,None)
+        
+    @staticmethod
+    def live_pixels(group):
+        ''' mask the rows of the pixel index that belong to the last
+            entry of each source (the others are stale) '''
+
+        index={s:(i,n) for s,i,n in group['sources'][:]}
+        live=np.zeros(group['pixels'].shape[0],dtype=bool)
+        for i0,n in index.values():
+            live[i0:i0+n]=True
+        return index,live
+
+    def stale_fraction(self,h5):
+        ''' the fraction of the file that is stale PDT rows, PDTs in the
+            older layout that were replaced, or space that was freed '''
+
+        pdts=[]
+        h5.visititems(lambda name,obj: pdts.append(obj) if \
+                      isinstance(obj,h5py.Group) and \
+                      name.split('/')[-1]=='pdt' and 'sources' in obj \
+                      else None)
+
+        # the storage of the datasets
+        sizes=[]
+        h5.visititems(lambda name,obj: sizes.append(obj.id.get_storage_size())\
+                      if isinstance(obj,h5py.Dataset) else None)
+        stale=0
+        for group in pdts:
+            index,live=self.live_pixels(group)
+            count=group['pixels']['count']
+            ndata=np.sum(count,dtype=np.uint64)
+            if ndata>0:
+                frac=1.-np.sum(count[live],dtype=np.uint64)/ndata
+                stale+=frac*group['data'].id.get_storage_size()
+            if len(live)>0:
+                frac=1.-np.count_nonzero(live)/len(live)
+                stale+=frac*group['pixels'].id.get_storage_size()
+            for name,obj in group.items():
+                if name not in self.PDTNAMES:
+                    stale+=obj.id.get_storage_size()
+        size=os.path.getsize(self.filename)
+        stale+=max(size-sum(sizes),0)
+        return stale/size if size>0 else 0.
+
+    def compact(self,maxstale=None):
+        ''' rewrite a (closed) file without the stale PDTs, once they are
+            more than maxstale of the file '''
+
+        maxstale=self.MAXSTALE if maxstale is None else maxstale
+        if not os.path.isfile(self.filename):
+            return
+        with h5py.File(self.filename,'r') as h5:
+            if self.stale_fraction(h5)<=maxstale:
+                return
+
+        print('[info]Compacting {}'.format(self.filename))
+        tmpfile='{}.{}.tmp'.format(self.filename,os.getpid())
+        with h5py.File(self.filename,'r') as src,h5py.File(tmpfile,'w') as dst:
+            self.copy_group(src,dst)
+        os.replace(tmpfile,self.filename)
+        self.pdtsources.clear()
+
+    def copy_group(self,src,dst):
+        ''' copy a group, keeping only the valid columnar PDTs '''
+
+        for k,v in src.attrs.items():
+            dst.attrs[k]=v
+        columnar=src.name.split('/')[-1]=='pdt' and 'sources' in src
+        for name,obj in src.items():
+            if isinstance(obj,h5py.Group):
+                self.copy_group(obj,dst.create_group(name))
+            elif not columnar or name=='fingerprints':
+                src.copy(obj,dst,name=name)
+        if columnar:
+            self.copy_pdts(src,dst)
+
+    def copy_pdts(self,src,dst):
+        ''' copy the last entry of each source in the columnar PDTs '''
+
+        index,live=self.live_pixels(src)
+        data,pixels,sources=[],[],[]
+        ndata,npixel,nbuf=0,0,0
+        for segid,(i0,n) in sorted(index.items(),key=lambda v: v[1][0]):
+            pix=src['pixels'][i0:i0+n]
+            if n>0:
+                j0=int(pix['start'][0])
+                j1=j0+int(np.sum(pix['count'],dtype=np.uint64))
+                data.append(src['data'][j0:j1])
+                pix['start']=pix['start']-np.uint64(j0)+np.uint64(ndata)
+                ndata+=j1-j0
+                nbuf+=j1-j0
+            pixels.append(pix)
+            sources.append((segid,npixel,n))
+            npixel+=n
+
+            # write in blocks, which bounds the memory
+            if nbuf>=16*self.CHUNKSIZE:
+                self.append_data('data',np.concatenate(data),group=dst)
+                data,nbuf=[],0
+        if data:
+            self.append_data('data',np.concatenate(data),group=dst)
+        if pixels:
+            self.append_data('pixels',np.concatenate(pixels),group=dst)
+        self.append_data('sources',np.array(sources,dtype=self.PDTSOURCES),
+                         group=dst)
+
+    def load_pdt_index(self):
+        ''' load the source index of the columnar PDTs (cached per table) '''
+        
+        index=self.pdtsources.get(self.h5table.name)
+        if index is None:
+            if 'sources' in self.h5table:
+                data=self.h5table['sources'][:]
+                index={s:(i,n) for s,i,n in data}
+            else:
+                index={}
+            self.pdtsources[self.h5table.name]=index
+        return index
+        
+    def load_odt(self,source,beam,wav):
+        ''' load the ODT of a source from the columnar layout in bulk '''
+
+        index=self.load_pdt_index()
+        if source.segid not in index:
+            return None
+
+        # the direct-image pixels of the source
+        pixels=np.array(source.xyd,dtype=np.int64).reshape(-1,2)
+        pixlist=[tuple(p) for p in pixels.tolist()]
+        
+        # read the pixels of the source
+        i0,n=index[source.segid]
+        if n==0:
+            return ODT.from_arrays(source.segid,beam,wav,pixlist)
+        stored=self.h5table['pixels'][i0:i0+n]
+
+        # read the data of the source with a single slice.  The pixels
+        # of a source are written contiguously, so the data are in the
+        # same order as the pixel index
+        j0=int(stored['start'][0])
+        j1=j0+int(np.sum(stored['count'],dtype=np.uint64))
+        data=self.h5table['data'][j0:j1]
+        
+        # match the stored pixels to those of the source
+        keys=pixels[:,0]+65536*pixels[:,1]
+        order=np.argsort(keys)
+        skeys=stored['x'].astype(np.int64)+65536*stored['y'].astype(np.int64)
+        k=np.clip(np.searchsorted(keys,skeys,sorter=order),0,len(keys)-1)
+        k=order[k]
+        good=keys[k]==skeys
+        
+        # the pixel id of each element, dropping pixels not in the source
+        pid=np.repeat(k,stored['count'])
+        g=np.repeat(good,stored['count'])
+
+        # apply the direct-image weights in one go
+        wht=np.asarray(source.wht,dtype=np.float64)
+        pid=pid[g]
+        return ODT.from_arrays(source.segid,beam,wav,pixlist,pid,data['x'][g],
+                               data['y'][g],data['lam'][g],
+                               data['val'][g]*wht[pid])
+        
     def load_from_file(self,source,beam,ttype):
 
         if ttype=='odt':
@@ -52,12 +300,18 @@ class H5Table(H5TableBase):
             wav1=self.load_attribute(self.h5table,'wav1')
             dwav=self.load_attribute(self.h5table,'dwav')
             wav=np.arange(wav0,wav1+dwav,dwav)
-            
-            tab=ODT(source.segid,beam,wav)
-            for pixel,wht in zip(source.xyd,source.wht):
-                pdt=PDT.load(pixel,self.h5table)
-                pdt*=wht
-                tab.extend(pdt)
+
+            # load the columnar layout, if absent use the older
+            # layout of one dataset per pixel
+            tab=self.load_odt(source,beam,wav)
+            if tab is None:
+                pdts=[]
+                for pixel,wht in zip(source.xyd,source.wht):
+                    pdt=PDT.load(pixel,self.h5table)
+                    pdt*=wht
+                    pdts.append(pdt)
+                tab=ODT(source.segid,beam,wav)
+                tab.extend(*pdts)
         elif ttype=='omt':
             tab=OMT.load(source.segid,beam,self.h5table)
         else:
@@ -87,17 +87,19 @@ class H5TableBase(object):
         if n==0:
             return None
         elif n==1:
-            data=np.array(args[0]) #np.array(list(args[0]))
-            dtype=args[0].dtype #(args[0].name,args[0].dtype)
+            data=np.asarray(args[0],dtype=args[0].dtype)
         
         else:
-            data=list(zip(*args))
+            # fill a structured array directly from the columns
             dtype=[(arg.name,arg.dtype) for arg in args]
+            data=np.empty(len(args[0]),dtype=dtype)
+            for arg in args:
+                data[arg.name]=arg.view
 
         # try this for overwriting data in an h5
         if name in h5:
             del h5[name]
-        hd=h5.create_dataset(name,data=np.array(data,dtype=dtype),**COMPARGS)
+        hd=h5.create_dataset(name,data=data,**COMPARGS)
             
 
         # these are the columns
@@ -12,40 +12,68 @@ from .ovt import OVT
 from . import columns
 
 
-class ODT(H5TableBase,dict):
+class ODT(H5TableBase):
     def __init__(self,segid,beam,wav):
         self.segid=segid
         self.beam=beam
         self.wav=wav
 
+        # the direct-image pixels and the flat arrays of the table.  The
+        # pixel id (pid) is the index of the direct-image pixel
+        self.pixels=[]
+        self.pid=np.zeros(0,dtype=np.uint32)
+        self.x=np.zeros(0,dtype=np.uint16)
+        self.y=np.zeros(0,dtype=np.uint16)
+        self.lam=np.zeros(0,dtype=np.uint16)
+        self.val=np.zeros(0,dtype=np.float64)
+
+    @classmethod
+    def from_arrays(cls,segid,beam,wav,pixels,pid=None,x=None,y=None,
+                    lam=None,val=None):
+        ''' build an ODT from the pixels and the flat arrays of the table '''
+        
+        odt=cls(segid,beam,wav)
+        odt.pixels=list(pixels)
+        if pid is not None:
+            assert (len(pid)==len(x)==len(y)==len(lam)==len(val)),\
+                'Invalid arrays'
+            odt.pid=np.asarray(pid,dtype=np.uint32)
+            odt.x=np.asarray(x,dtype=np.uint16)
+            odt.y=np.asarray(y,dtype=np.uint16)
+            odt.lam=np.asarray(lam,dtype=np.uint16)
+            odt.val=np.asarray(val,dtype=np.float64)
+        return odt
+
     def __imul__(self,a):
-        for k in self.keys():
-            self[k]*=a
+        self.val=self.val*a
         return self
+
+    def __len__(self):
+        return len(self.pixels)
         
     def __iter__(self):
-        yield from self.values()
-
-    def threshold(self,v):
-        for pdt in self:
-            pdt.threshold(v)
-
-    def flatten(self,arrays=True):
-        x,y,w,v=[],[],[],[]
-        for pdt in self:
-            x.extend(pdt.x)
-            y.extend(pdt.y)
-            w.extend(self.wav[pdt.lam])
-            v.extend(pdt.val)
-        if arrays:
-            x=np.array(x)
-            y=np.array(y)
-            w=np.array(w)
-            v=np.array(v)
+        ''' iterate over the PDTs of each direct-image pixel '''
         
+        i=np.argsort(self.pid,kind='stable')
+        pid,x,y,lam,val=self.pid[i],self.x[i],self.y[i],self.lam[i],self.val[i]
+        ptr=np.searchsorted(pid,np.arange(len(self.pixels)+1))
+        for pixel,i0,i1 in zip(self.pixels,ptr[:-1],ptr[1:]):
+            yield PDT(pixel,x[i0:i1],y[i0:i1],lam[i0:i1],val[i0:i1])
+
+    def select(self,g):
+        self.pid=self.pid[g]
+        self.x=self.x[g]
+        self.y=self.y[g]
+        self.lam=self.lam[g]
+        self.val=self.val[g]
         
+    def threshold(self,v):
+        self.select(self.val >= v)
 
-            
+    def flatten(self,arrays=True):
+        x,y,w,v=self.x,self.y,self.wav[self.lam],self.val
+        if not arrays:
+            x,y,w,v=list(x),list(y),list(w),list(v)
         return x,y,w,v
             
 
@@ -54,9 +82,20 @@ class ODT(H5TableBase,dict):
     def name(self):
         return str(self.segid)
 
-    def extend(self,pdt):
-        assert isinstance(pdt,PDT),'ODT can only extend a PDT'
-        self[pdt.pixel]=pdt
+    def extend(self,*pdts):
+        for pdt in pdts:
+            assert isinstance(pdt,PDT),'ODT can only extend a PDT'
+        if len(pdts)==0:
+            return
+        
+        n=len(self.pixels)
+        self.pixels.extend(pdt.pixel for pdt in pdts)
+        pid=[np.full(len(pdt),n+i,dtype=np.uint32) for i,pdt in enumerate(pdts)]
+        self.pid=np.concatenate([self.pid]+pid)
+        self.x=np.concatenate([self.x]+[pdt.x.view for pdt in pdts])
+        self.y=np.concatenate([self.y]+[pdt.y.view for pdt in pdts])
+        self.lam=np.concatenate([self.lam]+[pdt.lam.view for pdt in pdts])
+        self.val=np.concatenate([self.val]+[pdt.val.view for pdt in pdts])
   
     def write_h5(self,h5,**kwargs):
         hs=self.write_group(h5,self.name,**kwargs)        
@@ -67,8 +106,8 @@ class ODT(H5TableBase,dict):
         self.write_attribute(hf,'dwav',self.wav[1]-self.wav[0])
         self.write_attribute(hf,'npix',np.uint32(len(self)))
         
-        for k,v in self.items():
-            v.write_h5(hf)
+        for pdt in self:
+            pdt.write_h5(hf)
 
 
     @classmethod
@@ -80,9 +119,7 @@ class ODT(H5TableBase,dict):
         wav=np.arange(wav0,wav1+dwav,dwav)
         
         odt=cls(segid,beam,wav)
-        for pix in hf.keys():
-            pdt=PDT.load(pix,hf)
-            odt.extend(pdt)
+        odt.extend(*(PDT.load(pix,hf) for pix in hf.keys()))
         return odt
         
 
@@ -94,17 +131,14 @@ class ODT(H5TableBase,dict):
 
             
             # get all the (x,y) pairs
-            x,y=[],[]
-            for pdt in self:
-                x.extend(pdt.x)
-                y.extend(pdt.y)
+            x,y=self.x,self.y
 
             # only compute convex hull if there are points
             if len(x)>0:
                 
                 # make them np arrays
-                x=np.array(x,dtype=np.uint64)
-                y=np.array(y,dtype=np.uint64)
+                x=x.astype(np.uint64)
+                y=y.astype(np.uint64)
                 
                 # uniqify the pairs
                 x,y=indices.unique_pairs(x,y)
@@ -147,41 +181,29 @@ class ODT(H5TableBase,dict):
 
     
     def decimate(self,nx,ny):
-        if len(self)!=0:
+        if len(self.val)!=0:
 
             # get some values for quicker access
-            npix=np.uint64(nx)*np.uint64(ny)
+            nx=np.uint64(nx)
+            npix=nx*np.uint64(ny)
 
             # get the values to decimate
-            xyl,val=[],[]
-
-            for pdt in self:
-                xy=pdt.x.astype(np.uint64)+nx*pdt.y.astype(np.uint64)
-                xyl.extend(xy+npix*pdt.lam.astype(np.uint64))
-                val.extend(pdt.val.astype(np.float64))
-            if len(xyl)>0:
-                xyl=np.array(xyl)
-                val=np.array(val)
-            
-                # find unique indices & compress
-                xylu=np.unique(xyl)
-                xylc=np.digitize(xyl,xylu)-1
+            xyl=self.x.astype(np.uint64)+nx*self.y.astype(np.uint64)
+            xyl+=npix*self.lam.astype(np.uint64)
                 
-                # sum over repeated indices
-                vu=np.bincount(xylc,weights=val)
+            # find unique indices & sum over repeated indices
+            xylu,xylc=np.unique(xyl,return_inverse=True)
+            vu=np.bincount(xylc,weights=self.val)
 
-                # go back to 1d indices
-                lamu,xygu=np.divmod(xylu,npix)
-                yu,xu=np.divmod(xygu,nx)
+            # go back to 1d indices
+            lamu,xygu=np.divmod(xylu,npix)
+            yu,xu=np.divmod(xygu,nx)
                 
-                # get the wavelengths
-                wu=self.wav[lamu]
+            # get the wavelengths
+            wu=self.wav[lamu]
                 
-                # return the DDT            
-                ddt=DDT(self.segid,xu,yu,wu,vu)
-            else:
-                # a null table
-                ddt=DDT(self.segid)
+            # return the DDT            
+            ddt=DDT(self.segid,xu,yu,wu,vu)
         else:
             # a null table
             ddt=DDT(self.segid)
@@ -0,0 +1,101 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+
+class BeamMask(object):
+    ''' full-field masks of the beams, cached as packed bitmaps '''
+
+    def __init__(self,sources,mskbeams,path='tables',min_rate=1e-2):
+        self.mskbeams=list(mskbeams)
+        self.path=path
+        self.min_rate=min_rate
+
+        # the notional flux of each source
+        photflam=sources.obscat.detband.photflam
+        self.flam={source.segid:source.total*photflam for source in sources}
+
+        # the masks that are loaded (packed), for each dataset/device
+        self.masks={}
+
+    @property
+    def signature(self):
+        ''' hash the inputs common to all the masks '''
+
+        sha=hashlib.sha1(str((self.mskbeams,self.min_rate)).encode())
+        for segid,flam in sorted(self.flam.items()):
+            sha.update(str((segid,flam)).encode())
+        return sha.hexdigest()
+
+    def key(self,h5tab,device):
+        ''' hash the inputs to the mask of a device '''
+
+        sha=hashlib.sha1(self.signature.encode())
+        for beam in self.mskbeams:
+            h5tab.open_table(device.name,beam,'omt')
+            fps=h5tab.load_fingerprints()
+            for segid in sorted(fps.keys()):
+                sha.update(str((segid,fps[segid])).encode())
+        return sha.hexdigest()
+
+    def filename(self,dataset,devname,key):
+        # the masks of each set of sources are kept separately
+        return os.path.join(self.path,'{}_{}_{}_{}_msk.npy'.format(dataset,
+            devname,self.signature[:12],key))
+
+    def prepare(self,h5tab,device):
+        ''' make the mask file of a device (if needed) '''
+
+        key=self.key(h5tab,device)
+        filename=self.filename(h5tab.dataset,device.name,key)
+        if filename not in self.masks and not os.path.isfile(filename):
+            bits=np.packbits(self.compute(h5tab,device))
+            self.save(filename,bits,h5tab.dataset,device.name)
+        return filename
+        
+    def __call__(self,h5tab,device):
+        ''' the mask of the device (True where a beam falls) '''
+
+        shape=(device.naxis2,device.naxis1)
+        filename=self.prepare(h5tab,device)
+        if filename in self.masks:
+            bits=self.masks[filename]
+        else:
+            bits=np.load(filename)
+        self.masks[filename]=bits
+
+        count=shape[0]*shape[1]
+        return np.unpackbits(bits,count=count).view(bool).reshape(shape)
+
+    def compute(self,h5tab,device):
+        ''' mask the pixels of the bright sources in the mask beams '''
+
+        print('[info]Making beam mask for {} {}'.format(h5tab.dataset,
+                                                       device.name))
+        beam_mask=np.zeros((device.naxis2,device.naxis1),dtype=bool)
+        for beam in self.mskbeams:
+            config=device.load_beam(beam)
+            h5tab.open_table(device.name,beam,'omt')
+
+            # only mask the pixels if the source is bright enough,
+            # given a notional peak count rate in a grism image
+            smax=config.sensitivity.smax
+            for segid,flam in self.flam.items():
+                name=str(segid)
+                if flam*smax > self.min_rate and name in h5tab.h5table:
+                    data=h5tab.h5table[name][()]
+                    beam_mask[data['y'],data['x']]=True
+        return beam_mask
+
+    def save(self,filename,bits,dataset,devname):
+        ''' write a mask atomically, and remove any stale masks '''
+
+        stale=glob.glob(self.filename(dataset,devname,'*'))
+        tmpfile='{}.{}.tmp'.format(filename,os.getpid())
+        with open(tmpfile,'wb') as fp:
+            np.save(fp,bits)
+        os.replace(tmpfile,filename)
+        for f in stale:
+            if f!=filename and os.path.isfile(f):
+                os.remove(f)
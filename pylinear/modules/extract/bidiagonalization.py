@@ -0,0 +1,270 @@
+import numpy as np
+from math import sqrt
+
+
+def sym_ortho(a,b):
+    ''' a stable Givens rotation (as in LSQR) '''
+    if b==0:
+        return np.sign(a),0,abs(a)
+    elif a==0:
+        return 0,np.sign(b),abs(b)
+    elif abs(b)>abs(a):
+        tau=a/b
+        s=np.sign(b)/sqrt(1+tau*tau)
+        c=s*tau
+        r=b/s
+    else:
+        tau=b/a
+        c=np.sign(a)/sqrt(1+tau*tau)
+        s=c*tau
+        r=a/c
+    return c,s,r
+
+
+class Bidiagonalization(object):
+    ''' Golub-Kahan bidiagonalization shared over many damping values
+
+    The Krylov subspace of LSQR does not depend on the damping, so the
+    bidiagonalization of (A,b) is done once.  The recurrences of LSQR
+    are then replayed for each damping in one pass over the Lanczos
+    vectors, and the search directions are updated as vectors (as in
+    LSQR), so the condition estimate and the stopping tests do not
+    assume that the Lanczos vectors are orthonormal.  The vectors are
+    stored if they fit in MAXMEM bytes, else they are regenerated in
+    the pass over the matrix.
+    '''
+
+    MAXMEM=2**31      # max number of bytes to store the Lanczos vectors
+
+    def __init__(self,A,b,atol=1e-6,btol=1e-6,conlim=1e8,iter_lim=None,
+                 maxmem=None):
+        self.A=A
+        self.b=np.asarray(b,dtype=np.float64)
+        m,n=A.shape
+
+        # settings for the stopping criteria
+        self.atol=atol
+        self.btol=btol
+        self.ctol=1./conlim if conlim>0 else 0.
+        self.iter_lim=2*n if iter_lim is None else iter_lim
+        self.maxmem=self.MAXMEM if maxmem is None else maxmem
+
+        # start the bidiagonalization
+        self.bnorm=np.linalg.norm(self.b)
+        self.alfas=[]     # the diagonal of B
+        self.betas=[]     # the sub-diagonal of B (the first is ||b||)
+        self.V=[]         # the Lanczos vectors (or None if not stored)
+
+        self.u,self.v,alfa,beta=self.start()
+        self.alfas.append(alfa)
+        self.betas.append(beta)
+        if self.V is not None:
+            self.V.append(self.v)
+
+    def __len__(self):
+        ''' number of iterations of the bidiagonalization '''
+        return len(self.alfas)-1
+
+    def start(self):
+        beta=self.bnorm
+        u=self.b.copy()
+        if beta>0:
+            u=(1./beta)*u
+            v=self.A.rmatvec(u)
+            alfa=np.linalg.norm(v)
+        else:
+            v=np.zeros(self.A.shape[1],dtype=np.float64)
+            alfa=0.
+        if alfa>0:
+            v=(1./alfa)*v
+        return u,v,alfa,beta
+
+    def step(self,u,v,alfa):
+        ''' one step of the bidiagonalization '''
+        u=self.A.matvec(v)-alfa*u
+        beta=np.linalg.norm(u)
+        if beta>0:
+            u=(1./beta)*u
+            v=self.A.rmatvec(u)-beta*v
+            alfa=np.linalg.norm(v)
+            if alfa>0:
+                v=(1./alfa)*v
+        return u,v,alfa,beta
+
+    def extend(self):
+        ''' take one more step of the bidiagonalization '''
+        self.u,self.v,alfa,beta=self.step(self.u,self.v,self.alfas[-1])
+        self.alfas.append(alfa)
+        self.betas.append(beta)
+
+        # store the vector, if there is room
+        if self.V is not None:
+            if (len(self.V)+1)*self.v.nbytes > self.maxmem:
+                print('[info]Lanczos vectors will be regenerated')
+                self.V=None
+            else:
+                self.V.append(self.v)
+
+    def vectors(self):
+        ''' the Lanczos vectors, stored, regenerated or extended '''
+        k=0
+        while True:
+            if k>len(self):
+                self.extend()
+                u,v,alfa=self.u,self.v,self.alfas[-1]
+            elif self.V is not None:
+                v=self.V[k]
+            elif k==0:
+                u,v,alfa,beta=self.start()
+            else:
+                u,v,alfa,beta=self.step(u,v,alfa)
+            yield v
+            k+=1
+
+    def replay(self,damp,calc_var=True):
+        ''' the recurrences of LSQR for a damping, sent the Lanczos vectors '''
+
+        n=self.A.shape[1]
+        dampsq=damp*damp
+        eps=np.finfo(np.float64).eps
+
+        itn=0
+        istop=0
+        anorm=0.
+        acond=0.
+        ddnorm=0.
+        res2=0.
+        xnorm=0.
+        xxnorm=0.
+        z=0.
+        cs2=-1.
+        sn2=0.
+
+        alfa,beta=self.alfas[0],self.betas[0]
+        rhobar=alfa
+        phibar=beta
+        rnorm=beta
+        r1norm=rnorm
+        r2norm=rnorm
+        arnorm=alfa*beta
+
+        # the solution and variance, with the search direction
+        v=yield
+        x=np.zeros(n,dtype=np.float64)
+        var=np.zeros(n,dtype=np.float64)
+        w=v.copy()
+
+        if arnorm==0:
+            return x,istop,itn,r1norm,r2norm,anorm,acond,arnorm,xnorm,var
+
+        while itn<self.iter_lim:
+            itn+=1
+
+            # the next Lanczos vector (which extends the factors as needed)
+            v=yield
+            beta,alfa=self.betas[itn],self.alfas[itn]
+            if beta>0:
+                anorm=sqrt(anorm**2+self.alfas[itn-1]**2+beta**2+dampsq)
+
+            # eliminate the damping
+            if damp>0:
+                rhobar1=sqrt(rhobar**2+dampsq)
+                cs1=rhobar/rhobar1
+                sn1=damp/rhobar1
+                psi=sn1*phibar
+                phibar=cs1*phibar
+            else:
+                rhobar1=rhobar
+                psi=0.
+
+            # eliminate the subdiagonal
+            cs,sn,rho=sym_ortho(rhobar1,beta)
+            theta=sn*alfa
+            rhobar=-cs*alfa
+            phi=cs*phibar
+            phibar=sn*phibar
+            tau=sn*phi
+
+            # update the solution and the search direction
+            dk=(1./rho)*w
+            x+=(phi/rho)*w
+            w=v+(-theta/rho)*w
+            ddnorm+=np.linalg.norm(dk)**2
+            if calc_var:
+                var+=dk*dk
+
+            # estimate the norm of x
+            delta=sn2*rho
+            gambar=-cs2*rho
+            rhs=phi-delta*z
+            zbar=rhs/gambar
+            xnorm=sqrt(xxnorm+zbar**2)
+            gamma=sqrt(gambar**2+theta**2)
+            cs2=gambar/gamma
+            sn2=theta/gamma
+            z=rhs/gamma
+            xxnorm+=z**2
+
+            # the norms of A and the residuals
+            acond=anorm*sqrt(ddnorm)
+            res1=phibar**2
+            res2+=psi**2
+            rnorm=sqrt(res1+res2)
+            arnorm=alfa*abs(tau)
+
+            if damp>0:
+                r1sq=rnorm**2-dampsq*xxnorm
+                r1norm=sqrt(abs(r1sq))
+                if r1sq<0:
+                    r1norm=-r1norm
+            else:
+                r1norm=rnorm
+            r2norm=rnorm
+
+            # the stopping criteria of LSQR
+            test1=rnorm/self.bnorm
+            test2=arnorm/(anorm*rnorm+eps)
+            test3=1./(acond+eps)
+            t1=test1/(1+anorm*xnorm/self.bnorm)
+            rtol=self.btol+self.atol*anorm*xnorm/self.bnorm
+
+            if itn>=self.iter_lim:
+                istop=7
+            if 1+test3<=1:
+                istop=6
+            if 1+test2<=1:
+                istop=5
+            if 1+t1<=1:
+                istop=4
+            if test3<=self.ctol:
+                istop=3
+            if test2<=self.atol:
+                istop=2
+            if test1<=rtol:
+                istop=1
+            if istop!=0:
+                break
+
+        return x,istop,itn,r1norm,r2norm,anorm,acond,arnorm,xnorm,var
+
+    def solve(self,damps,calc_var=True):
+        ''' solve for many damping values, returns the outputs of LSQR '''
+
+        # start the recurrences for each damping
+        states=[self.replay(damp,calc_var=calc_var) for damp in damps]
+        for state in states:
+            next(state)
+        results=[None]*len(states)
+
+        # one pass over the Lanczos vectors for all dampings
+        for v in self.vectors():
+            for i,state in enumerate(states):
+                if results[i] is None:
+                    try:
+                        state.send(v)
+                    except StopIteration as stop:
+                        results[i]=stop.value
+            if all(r is not None for r in results):
+                break
+
+        return results
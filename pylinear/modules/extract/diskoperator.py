@@ -0,0 +1,272 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+import scipy.sparse.linalg as ssl
+from scipy.sparse import csr_matrix
+
+
+class RowStore(object):
+    ''' append blocks of rows of a sparse matrix to an HDF5 file '''
+
+    # number of elements in a chunk of the datasets
+    CHUNKSIZE=2**20
+
+    def __init__(self,path,precision='double'):
+        if precision=='single':
+            self.vtype=np.float32
+        elif precision=='double':
+            self.vtype=np.float64
+        else:
+            raise NotImplementedError("Precision not found.")
+
+        # a scratch file, which is removed with the operator.  It is put
+        # with the tables, as the system directory may be small
+        fd,self.filename=tempfile.mkstemp(suffix='.h5',prefix='matrix_',
+                                          dir=path)
+        os.close(fd)
+        self.h5=h5py.File(self.filename,'w')
+        self.hd=self.h5.create_group('csr')
+
+        self.nrow=0
+        self.nnz=0
+        self.append_data('indptr',np.zeros(1,dtype=np.int64))
+
+    def append_data(self,name,data):
+        ''' append to a resizable dataset '''
+
+        if name in self.hd:
+            hd=self.hd[name]
+        else:
+            hd=self.hd.create_dataset(name,shape=(0,),dtype=data.dtype,
+                                      maxshape=(None,),
+                                      chunks=(self.CHUNKSIZE,))
+        start=hd.shape[0]
+        if len(data)>0:
+            hd.resize((start+len(data),))
+            hd[start:]=data
+
+    def append(self,i,j,aij,bi):
+        ''' append rows, whose indices must follow the previous rows '''
+
+        # sort the elements by row
+        order=np.argsort(i,kind='stable')
+        iuniq,rownnz=np.unique(i,return_counts=True)
+        if len(iuniq)!=len(bi):
+            print('[warn]Invalid dimensionality in matrix')
+
+        self.append_data('iuniq',iuniq)
+        self.append_data('bi',np.asarray(bi,dtype=np.float64))
+        self.append_data('indices',np.asarray(j[order],dtype=np.int64))
+        self.append_data('data',np.asarray(aij[order],dtype=self.vtype))
+        self.append_data('indptr',self.nnz+np.cumsum(rownnz,dtype=np.int64))
+        self.nrow+=len(iuniq)
+        self.nnz+=len(aij)
+
+    def finish(self,ncol):
+        ''' close the store, returns the row data and the operator '''
+
+        self.hd.attrs['shape']=(self.nrow,ncol)
+        iuniq=self.hd['iuniq'][:] if 'iuniq' in self.hd else np.array([])
+        bi=self.hd['bi'][:] if 'bi' in self.hd else np.array([])
+        self.h5.close()
+        return iuniq,bi
+
+
+class DiskOperator(ssl.LinearOperator):
+    ''' a sparse matrix in an HDF5 file, streamed in blocks of rows '''
+
+    # number of non-zero elements to read at once
+    BLOCKSIZE=2**22
+
+    def __init__(self,filename,group='csr',juniq=None,scratch=False):
+        self.filename=filename
+        self.group=group
+        self.scratch=scratch      # remove the file with the operator
+
+        self.h5=h5py.File(self.filename,'r')
+        self.csc=None             # a column-ordered copy, made if needed
+        hd=self.h5[self.group]
+        self.indptr=hd['indptr'][:].astype(np.int64)
+        nrow,ncol=hd.attrs['shape']
+
+        # the stored column indices may be uncompressed, in which case
+        # the compressed columns are the unique columns (juniq)
+        if juniq is None:
+            self.lookup=None
+        else:
+            self.lookup=np.full(ncol,-1,dtype=np.int64)
+            self.lookup[juniq]=np.arange(len(juniq))
+            ncol=len(juniq)
+
+        if hd['data'].dtype==np.float32:
+            self.precision='single'
+        else:
+            self.precision='double'
+
+        # the blocks of rows that have about BLOCKSIZE elements
+        self.bounds=[]
+        i0=0
+        while i0 < nrow:
+            a=self.indptr[i0]
+            i1=np.searchsorted(self.indptr,a+self.BLOCKSIZE,side='right')-1
+            i1=min(max(i1,i0+1),nrow)
+            self.bounds.append((i0,i1))
+            i0=i1
+
+        # the blocks are read in double precision, so the products are
+        # accumulated in double precision
+        super().__init__(np.float64,(int(nrow),int(ncol)))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self,'h5',None) is not None:
+            self.h5.close()
+            self.h5=None
+            if self.scratch and os.path.isfile(self.filename):
+                os.remove(self.filename)
+        if getattr(self,'csc',None) is not None:
+            filename=self.csc.filename
+            self.csc.close()
+            if os.path.isfile(filename):
+                os.remove(filename)
+            self.csc=None
+
+    @property
+    def nnz(self):
+        return int(self.indptr[-1])
+
+    def blocks(self):
+        ''' iterate over the blocks of rows as CSR matrices '''
+
+        hd=self.h5[self.group]
+        for i0,i1 in self.bounds:
+            a,b=self.indptr[i0],self.indptr[i1]
+            data=hd['data'][a:b].astype(np.float64)
+            indices=hd['indices'][a:b]
+            if self.lookup is not None:
+                indices=self.lookup[indices]
+            blk=csr_matrix((data,indices,self.indptr[i0:i1+1]-a),
+                           shape=(i1-i0,self.shape[1]))
+            yield i0,blk
+
+    def _matvec(self,x):
+        x=np.asarray(x,dtype=np.float64)
+        y=np.empty((self.shape[0],)+x.shape[1:],dtype=np.float64)
+        for i0,blk in self.blocks():
+            y[i0:i0+blk.shape[0]]=blk.dot(x)
+        return y
+
+    def _rmatvec(self,x):
+        x=np.asarray(x,dtype=np.float64)
+        y=np.zeros((self.shape[1],)+x.shape[1:],dtype=np.float64)
+        for i0,blk in self.blocks():
+            y+=blk.T.dot(x[i0:i0+blk.shape[0]])
+        return y
+
+    def _matmat(self,X):
+        return self._matvec(X)
+
+    def column_sumsq(self):
+        ''' sum of the squares of the elements in each column '''
+
+        sumsq=np.zeros(self.shape[1],dtype=np.float64)
+        for i0,blk in self.blocks():
+            sumsq+=np.bincount(blk.indices,weights=blk.data*blk.data,
+                               minlength=self.shape[1])
+        return sumsq
+
+    def column_index(self):
+        ''' a column-ordered copy of the matrix, which is written to a
+            scratch file (in three passes over the rows) when first used '''
+
+        if self.csc is not None:
+            return self.csc
+        print('[info]Indexing the columns of an out-of-core matrix')
+        ncol=self.shape[1]
+
+        # pass 1: the number of elements in each column
+        colnnz=np.zeros(ncol,dtype=np.int64)
+        for i0,blk in self.blocks():
+            colnnz+=np.bincount(blk.indices,minlength=ncol)
+        colptr=np.zeros(ncol+1,dtype=np.int64)
+        colptr[1:]=np.cumsum(colnnz)
+
+        # the groups of columns that have about BLOCKSIZE elements
+        edges=[0]
+        while edges[-1] < ncol:
+            a=colptr[edges[-1]]
+            j1=np.searchsorted(colptr,a+self.BLOCKSIZE,side='right')-1
+            edges.append(min(max(j1,edges[-1]+1),ncol))
+        edges=np.array(edges)
+
+        # the scratch file is put with the matrix
+        path=os.path.dirname(os.path.abspath(self.filename))
+        fd,filename=tempfile.mkstemp(suffix='.h5',prefix='columns_',dir=path)
+        os.close(fd)
+        h5=h5py.File(filename,'w')
+        nnz=max(self.nnz,1)
+        chunks=(min(RowStore.CHUNKSIZE,nnz),)
+        vtype=self.h5[self.group]['data'].dtype
+        rows=h5.create_dataset('indices',shape=(nnz,),dtype=np.int64,
+                               chunks=chunks)
+        vals=h5.create_dataset('data',shape=(nnz,),dtype=vtype,chunks=chunks)
+        cols=h5.create_dataset('cols',shape=(nnz,),dtype=np.int64,
+                               chunks=chunks)
+
+        # pass 2: put the elements in the region of their group of columns
+        cursor=colptr[edges[:-1]].copy()
+        hd=self.h5[self.group]
+        for i0,i1 in self.bounds:
+            a,b=self.indptr[i0],self.indptr[i1]
+            j=hd['indices'][a:b]
+            if self.lookup is not None:
+                j=self.lookup[j]
+            order=np.argsort(j,kind='stable')
+            j=j[order]
+            i=np.repeat(np.arange(i0,i1,dtype=np.int64),
+                        np.diff(self.indptr[i0:i1+1]))[order]
+            v=hd['data'][a:b][order]
+            splits=np.searchsorted(j,edges)
+            for k in np.where(np.diff(splits)>0)[0]:
+                s0,s1=splits[k],splits[k+1]
+                c0,c1=cursor[k],cursor[k]+s1-s0
+                rows[c0:c1]=i[s0:s1]
+                vals[c0:c1]=v[s0:s1]
+                cols[c0:c1]=j[s0:s1]
+                cursor[k]=c1
+
+        # pass 3: order the elements of each group by column (the sort is
+        # stable, so the rows remain in order)
+        for j0,j1 in zip(edges[:-1],edges[1:]):
+            a,b=colptr[j0],colptr[j1]
+            if b > a:
+                order=np.argsort(cols[a:b],kind='stable')
+                rows[a:b]=rows[a:b][order]
+                vals[a:b]=vals[a:b][order]
+        del h5['cols']
+
+        self.colptr=colptr
+        self.csc=h5
+        return self.csc
+
+    def column(self,j):
+        ''' the rows and values of the non-zero elements of a column '''
+
+        csc=self.column_index()
+        a,b=self.colptr[j],self.colptr[j+1]
+        return csc['indices'][a:b],csc['data'][a:b].astype(np.float64)
+
+    def tocoo(self):
+        print('[warn]Loading an out-of-core matrix into memory')
+        rows,cols,vals=[],[],[]
+        for i0,blk in self.blocks():
+            coo=blk.tocoo()
+            rows.append(coo.row+i0)
+            cols.append(coo.col)
+            vals.append(coo.data)
+        return csr_matrix((np.concatenate(vals),
+                           (np.concatenate(rows),np.concatenate(cols))),
+                          shape=self.shape).tocoo()
@@ -81,13 +81,27 @@ class Extract(object):
         return targ
 
 
-    def load_matrix_hdf5(self,sources,group=0):
+    def load_matrix_hdf5(self,sources,group=0,warmstart=False,
+                         precondition=False,outofcore=False):
         self.group=group
         if hasattr(self,'h5'):
             self.sources=sources
             self.optimized=False
-            self.matrix=Matrix.from_hdf5(self.h5,group)
+
+            # a cached matrix holds a single group, which may have been
+            # saved under a different group number
+            name=group
+            if str(group) not in self.h5 and len(self.h5.keys())==1:
+                name=list(self.h5.keys())[0]
+            self.matrix=Matrix.from_hdf5(self.h5,name,outofcore=outofcore)
             if self.matrix is not None:
+                # the settings of this run, not of the saved matrix
+                self.matrix.group=group
+                self.matrix.inverter=self.inverter
+                self.matrix.warmstart=warmstart
+                self.matrix.precondition=precondition
+                self.matrix.solutions=[]
+                
                 # do a quick test that segids match
                 if not all(s.segid in self.matrix.segids for s in self.sources):
                     print('[warn]Incompatible SEGIDs in matrix file.')
@@ -97,7 +111,10 @@ class Extract(object):
 
             
     def load_matrix_file(self,grisms,sources,beams,path,group=0,
-                         mskbeams=None,target=True,kernel=None):
+                         mskbeams=None,target=True,kernel=None,ncpu=1,
+                         precision='double',warmstart=False,
+                         precondition=False,codec='lzf',outofcore=False,
+                         beammask=None,flatdwav=None):
 
         self.group=group
         self.sources=sources
@@ -105,7 +122,11 @@ class Extract(object):
         
         # build the matrix into the self
         self.matrix=Matrix(grisms,sources,beams,path=path,mskbeams=mskbeams,
-                           group=group,inverter=self.inverter,kernel=kernel)
+                           group=group,inverter=self.inverter,kernel=kernel,
+                           ncpu=ncpu,precision=precision,
+                           warmstart=warmstart,precondition=precondition,
+                           outofcore=outofcore,beammask=beammask,
+                           flatdwav=flatdwav)
         if len(self.matrix)==0:
             print('[alarm]Matrix has no elements. Cannot set damping target.')
             return
@@ -118,7 +139,7 @@ class Extract(object):
 
         # save the matrix if
         if hasattr(self,'h5'):
-            self.matrix.to_hdf5(self.h5)
+            self.matrix.to_hdf5(self.h5,codec=codec)
         
             
     def golden_search(self,logdamp):
@@ -199,7 +220,7 @@ class Extract(object):
         logdamp = np.arange(logdamp[0],logdamp[1]+logdamp[2],logdamp[2])
 
         # get the states
-        states=[self.matrix.invert(ld) for ld in logdamp]
+        states=self.matrix.invert_many(logdamp)
 
         # compute the curvature
         curv=np.full_like(logdamp,np.nan)
@@ -400,24 +421,29 @@ class Extract(object):
             if len(self.matrix)>0:
                 x,y,l,i=self.matrix.lcurve.values()
                 c=self.matrix.lcurve.compute_curvature()
+                itn,warm=self.matrix.lcurve.counts(i)
             else:
                 # an empty matrix.  so make dummy data
                 x=np.array([])
                 y=np.array([])
                 l=np.array([])
                 c=np.array([])
+                itn=np.array([],dtype=int)
+                warm=np.array([],dtype=bool)
             # make the fits table columns
             col1=fits.Column(name='logdamp',format='1D',array=l)
             col2=fits.Column(name='logr1norm',format='1D',array=x)
             col3=fits.Column(name='logxnorm',format='1D',array=y)
             col4=fits.Column(name='curvature',format='1D',array=c)
-            cols=fits.ColDefs([col1,col2,col3,col4])
+            col5=fits.Column(name='niter',format='1J',array=itn)
+            col6=fits.Column(name='warm',format='1L',array=warm)
+            cols=fits.ColDefs([col1,col2,col3,col4,col5,col6])
 
             # package the data into a fits table
             hdu=fits.BinTableHDU.from_columns(cols)
 
             # update the group header
-            hdu.header.set('EXTNAME',value='GROUP',after='TFORM4',
+            hdu.header.set('EXTNAME',value='GROUP',after='TFORM6',
                            comment='extension name')
             hdu.header.set('EXTVER',value=self.group,after='EXTNAME',
                            comment='extension version')
@@ -443,6 +469,19 @@ class Extract(object):
                 nlcurve=0
             hdu.header.set('NLCURVE',value=nlcurve,after='LOGDAMP',
                            comment='number of L-curve steps')
+            hdu.header.set('NITER',value=getattr(self.matrix.lcurve,'niter',0),
+                           after='NLCURVE',
+                           comment='total iterations over the L-curve')
+            hdu.header.set('NWARM',value=int(np.sum(warm)),after='NITER',
+                           comment='number of warm-started steps')
+            hdu.header.set('ITNCOLD',
+                           value=self.matrix.lcurve.iterations(False),
+                           after='NWARM',
+                           comment='mean iterations of the cold starts')
+            hdu.header.set('ITNWARM',
+                           value=self.matrix.lcurve.iterations(True),
+                           after='ITNCOLD',
+                           comment='mean iterations of the warm starts')
             header_utils.add_stanza(hdu.header,'L-Curve Results',
                                     before='METHOD')
         else:
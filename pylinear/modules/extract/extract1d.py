@@ -11,12 +11,17 @@ from .. import header_utils
 from .residuals import Residuals
 from .extract import Extract
 from .groupcollection import GroupCollection
+from .matrixcache import MatrixCache
+from .beammask import BeamMask
 
 def extract1d(grisms,sources,beams,logdamp,method,fileroot,path,
               ncpu=0,gzip_residuals=True,
               group=True,grpfile=None,
               inverter='lsqr',mskbeams=None,              
-              kernel=None,usehdf5=False,matrix_path='matrices'):
+              kernel=None,usehdf5=True,matrix_path='matrices',
+              cachesize=None,codec='lzf',precision='double',
+              warmstart=False,precondition=False,outofcore=False,
+              flatdwav=None,matncpu=1):
               
     
 
@@ -76,10 +81,12 @@ def extract1d(grisms,sources,beams,logdamp,method,fileroot,path,
     extract=Extract(inverter=inverter,method=method)
 
     # open the matrix save file
-    matrix_path='matrices'
-    if not os.path.exists(matrix_path):
-        os.makedirs(matrix_path)
     #extract.open_matrix(,'r' if usehdf5 else 'w')
+
+    # the matrices are cached by a hash of their inputs
+    cache=MatrixCache(matrix_path,maxsize=cachesize)
+    tables=cache.load_tables(grisms,beams,path,mskbeams=mskbeams)
+    ncached=0
     
     # this will collect the outputs
     source_hdu={}
@@ -125,22 +132,37 @@ def extract1d(grisms,sources,beams,logdamp,method,fileroot,path,
             for segid in segids:
                 sources[segid]=sources_dict[segid]
 
+            # the beam masks of the sources in the group
+            beammask=BeamMask(sources,mskbeams,path=path) if mskbeams else None
 
 
             # create an HDF5 file for each group
-            matfile=os.path.join(matrix_path,'{}_grp{}.h5'.format(fileroot,group))
+            key=cache.key(grisms,sources,beams,tables,mskbeams=mskbeams,
+                          kernel=kernel,precision=precision,
+                          beammask=beammask,flatdwav=flatdwav)
                 
             # how to load the data
-            if usehdf5:              # load the matrix from HDF5
-                if kernel is not None:
-                    print('[warn]Kernel is not used with an HDF5 matrix')
-                extract.open_matrix(matfile,'r')
-                extract.load_matrix_hdf5(sources,group=group)
-            else:                    # build a matrix
-                extract.open_matrix(matfile,'w')
+            if usehdf5 and key in cache:   # load the matrix from HDF5
+                print('[info]Loading cached matrix for group {}'.format(group))
+                cache.touch(key)
+                extract.open_matrix(cache.filename(key),'r')
+                extract.load_matrix_hdf5(sources,group=group,
+                                         warmstart=warmstart,
+                                         precondition=precondition,
+                                         outofcore=outofcore)
+                extract.close_matrix()
+                ncached+=1
+            else:                          # build a matrix
+                extract.open_matrix(cache.tempname(key),'w')
                 extract.load_matrix_file(grisms,sources,beams,path,group=group,
-                                         mskbeams=mskbeams,kernel=kernel)
-            extract.close_matrix()
+                                         mskbeams=mskbeams,kernel=kernel,
+                                         ncpu=matncpu,precision=precision,
+                                         warmstart=warmstart,
+                                         precondition=precondition,
+                                         codec=codec,outofcore=outofcore,
+                                         beammask=beammask,flatdwav=flatdwav)
+                extract.close_matrix()
+                cache.commit(key)
                 
             # run the extraction method
             sres,gres=extract.run(logdamp,pdf=pdf,mcmc=False,
@@ -203,7 +225,9 @@ def extract1d(grisms,sources,beams,logdamp,method,fileroot,path,
     phdu.header.set('NSOURCE',value=len(sources),after='NGRISM',
                     comment='number of sources')
     phdu.header.set('HDF5MAT',value=usehdf5,after='NSOURCE',
-                    comment='loaded from HDF5 save file?')
+                    comment='reuse cached HDF5 matrices?')
+    phdu.header.set('NCACHED',value=ncached,after='HDF5MAT',
+                    comment='number of groups loaded from the cache')
     #phdu.header.set('GRISM',value=grisms.grism[0],after='NSOURCE',
     #                comment='grism element')
     #phdu.header.set('BLOCKING',value=grisms.grism[1],after='GRISM',
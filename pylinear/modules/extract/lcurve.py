@@ -15,6 +15,8 @@ class LCurve(object):
         self.y=[]       # = log(xnorm) (||f||)
         self.l=[]       # = log(damp)
         self.norm=norm
+        self.itn=[]     # = number of iterations
+        self.warm=[]    # = was warm started
         
         
     def __len__(self):
@@ -24,11 +26,34 @@ class LCurve(object):
         self.x.clear()
         self.y.clear()
         self.l.clear()
+        self.itn.clear()
+        self.warm.clear()
     
-    def append(self,x,y,l):
+    def append(self,x,y,l,itn=0,warm=False):
         self.x.append(np.log10(x))
         self.y.append(np.log10(y))
         self.l.append(l)
+        self.itn.append(int(itn))
+        self.warm.append(bool(warm))
+
+    @property
+    def niter(self):
+        ''' total number of iterations '''
+        return int(np.sum(self.itn))
+
+    def iterations(self,warm):
+        ''' mean number of iterations of the warm (or cold) starts '''
+        itn=[n for n,w in zip(self.itn,self.warm) if w==warm]
+        return float(np.mean(itn)) if itn else 0.
+
+    def counts(self,i=None):
+        ''' the number of iterations and the warm-start flags '''
+        itn=np.array(self.itn,dtype=int)
+        warm=np.array(self.warm,dtype=bool)
+        if i is not None:
+            itn=itn[i]
+            warm=warm[i]
+        return itn,warm
 
     def values(self,sort='x'):
         x=np.array(self.x)
@@ -84,18 +109,25 @@ class LCurve(object):
 
         x,y,l,i=self.values()
         c=self.compute_curvature()
+        itn,warm=self.counts(i)
         
         with open(filename,'w') as fp:
             print('# File written by pyLINEAR: {}'.format(date),file=fp)
             print('# FROBNORM = {}'.format(self.norm))
+            print('# NITER = {}'.format(self.niter),file=fp)
+            print('# NWARM = {}'.format(int(np.sum(warm))),file=fp)
+            print('# ITNCOLD = {}'.format(self.iterations(False)),file=fp)
+            print('# ITNWARM = {}'.format(self.iterations(True)),file=fp)
             print('# 1: iteration',file=fp)
             print('# 2: log(ell)',file=fp)
             print('# 3: log(||Ax-b||^2)',file=fp)
             print('# 4: log(||x||^2)',file=fp)
             print('# 5: curvature',file=fp)
-            for v in zip(i,l,x,y,c):
-                print('{0} {1:+.4f} {2:+.8e} {3:+.8e} {4:+.8e}'.format(*v),
-                      file=fp)
+            print('# 6: number of iterations',file=fp)
+            print('# 7: was warm started',file=fp)
+            fmt='{0} {1:+.4f} {2:+.8e} {3:+.8e} {4:+.8e} {5} {6}'
+            for v in zip(i,l,x,y,c,itn,warm.astype(int)):
+                print(fmt.format(*v),file=fp)
 
     @classmethod
     def load_ascii(cls,filename):
@@ -108,10 +140,16 @@ class LCurve(object):
         #obj.y=list(data['y'])
         #obj.l=list(data['l'])
 
-        (it,ld,lr,lx,cv),meta=ascii_file.read_ascii_columns(filename)
+        (it,ld,lr,lx,cv,*counts),meta=ascii_file.read_ascii_columns(filename)
         obj.x=list(lr)
         obj.y=list(lx)
         obj.l=list(ld)
+        if len(counts)==2:
+            obj.itn=[int(n) for n in counts[0]]
+            obj.warm=[bool(w) for w in counts[1]]
+        else:
+            obj.itn=[0]*len(obj.l)
+            obj.warm=[False]*len(obj.l)
         obj.norm=meta['FROBNORM']
         x,y,l
         
@@ -126,15 +164,28 @@ class LCurve(object):
         obj.x=list(dat['logr1norm'])
         obj.y=list(dat['logxnorm'])
         obj.l=list(dat['logdamp'])
+        if 'itn' in dat.dtype.names:
+            obj.itn=[int(n) for n in dat['itn']]
+            obj.warm=[bool(w) for w in dat['warm']]
+        else:
+            obj.itn=[0]*len(obj.l)
+            obj.warm=[False]*len(obj.l)
         return obj
 
     def write_hdf5(self,h5):
         dtype=[('logr1norm',np.float64),
                ('logxnorm',np.float64),
-               ('logdamp',np.float64)]
-        data=np.array(list(zip(self.x,self.y,self.l)),dtype=dtype)
+               ('logdamp',np.float64),
+               ('itn',np.int32),
+               ('warm',np.bool_)]
+        data=np.array(list(zip(self.x,self.y,self.l,self.itn,self.warm)),
+                      dtype=dtype)
         hd=h5.create_dataset('lcurve',data=data,**COMPARGS)
         hd.attrs['frob']=self.norm
+        hd.attrs['niter']=self.niter
+        hd.attrs['nwarm']=int(np.sum(self.warm))
+        hd.attrs['itncold']=self.iterations(False)
+        hd.attrs['itnwarm']=self.iterations(True)
 
     def write_pdf(self,pdf,colormap='Spectral',grpid=None):
           # define a colormap
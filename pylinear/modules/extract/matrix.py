@@ -8,21 +8,43 @@ from scipy.sparse import coo_matrix
 
 
 from .. import header_utils
-from ...utilities import indices
+from ...utilities import indices,Accumulator,Pool
 from ... import h5table
 from ...constants import COMPARGS
 from .lcurve import LCurve
 from .result import Result
 from .fluxunit import FLUXSCALE
+from .sparseoperator import SparseOperator
+from .bidiagonalization import Bidiagonalization
+from .statistics import Statistics
+from .diskoperator import RowStore,DiskOperator
+from .beammask import BeamMask
+
+def load_grism_unit(unit,loader,sources,extbeams,mskbeams):
+    ''' load a grism image (tagged with its index) in a worker '''
+    index,grism=unit
+    return index,loader.load_grism(grism,sources,extbeams,mskbeams)
+
 
 class Matrix(object):
     INT=np.uint64
     FLOAT=np.float64
     MINUNC=1e-10
 
+    # number of elements in a chunk of the matrix datasets
+    CHUNKSIZE=2**20
+
+    # compression of the matrix datasets (which are large)
+    CODECS={'lzf':{'compression':'lzf','shuffle':True},
+            'gzip':{'compression':'gzip','compression_opts':1,
+                    'shuffle':True},
+            'none':{}}
+
     #grisms,sources,extbeams,usehdf5=False,hdf5file='matrix.h5'
     def __init__(self,*args,group=0,inverter='lsqr',mskbeams=None,
-                 path='tables',kernel=None):
+                 path='tables',kernel=None,ncpu=1,precision='double',
+                 warmstart=False,precondition=False,outofcore=False,
+                 beammask=None,flatdwav=None):
 
         # parse the inputs
         n=len(args)
@@ -49,6 +71,30 @@ class Matrix(object):
         # set the inversion scheme
         self.inverter=inverter
 
+        # number of processes to build the matrix
+        self.ncpu=ncpu
+
+        # precision of the matrix elements (single or double)
+        self.precision=precision
+
+        # start each inversion from the nearest converged solution
+        self.warmstart=warmstart
+        self.solutions=[]
+
+        # equilibrate the columns of the matrix for LSQR/LSMR
+        self.precondition=precondition
+
+        # keep the matrix on disk and stream it for the products
+        self.outofcore=outofcore
+
+        # tabulate the chromatic flat fields every flatdwav (in A)
+        self.flatdwav=flatdwav
+
+        # the full-field masks of the beams to exclude
+        if mskbeams and beammask is None:
+            beammask=BeamMask(sources,mskbeams,path=self.path)
+        self.beammask=beammask
+
         
         # compute the number of wavelengths to extract
         nwav=[src.nwavelength() for src in sources]
@@ -68,19 +114,37 @@ class Matrix(object):
         #else:
         #    i,j,aij,self.bi=self.load_from_images(grisms,sources,extbeams,
         #                                          mskbeams,hdf5file)
-        i,j,aij,self.bi=self.load_from_images(grisms,sources,extbeams,mskbeams)
+        if self.outofcore:
+            # the rows are written to disk as each grism is loaded
+            store=RowStore(self.path,precision=self.precision)
+            i,j,aij,self.bi=self.load_from_images(grisms,sources,extbeams,
+                                                  mskbeams,store=store)
+            self.iuniq,self.bi=store.finish(self.npar)
+            i=self.iuniq
+        else:
+            i,j,aij,self.bi=self.load_from_images(grisms,sources,extbeams,
+                                                  mskbeams)
                                               
 
         # just do a quick check
         if len(i)==0:
             print('[alarm]Matrix has no elements.')
+            if self.outofcore:
+                os.remove(store.filename)
             return
 
        
-        # everthing is loaded, so let's juggle the indices
+        # everthing is loaded, so let's juggle the indices.  The rows
+        # and their number of elements come from the statistics
         print('[info]Compressing the indices')
-        self.icomp,self.iuniq=indices.compress(i)
-        self.jcomp,self.juniq=indices.compress(j)
+        self.rownnz=self.stats.rownnz
+        if self.outofcore:
+            # the columns with elements come from the statistics too
+            self.juniq=np.where(self.stats.colnnz>0)[0].astype(self.INT)
+        else:
+            self.iuniq=self.stats.rows
+            self.icomp=np.searchsorted(self.iuniq,i)
+            self.jcomp,self.juniq=indices.compress(j)
         
         #original lines
         #ic,iu=indices.compress(i)
@@ -92,7 +156,7 @@ class Matrix(object):
         dim=np.array([ni,nj],dtype=self.INT)
 
         # do a quick check
-        if np.amax(self.icomp)!=len(self.bi)-1:
+        if ni!=len(self.bi):
             print('[warn]Invalid dimensionality in matrix')
 
         
@@ -131,15 +195,20 @@ class Matrix(object):
         self.ri=indices.reverse(np.array(self.segids,dtype=int)[srcind])
         self.hsrc = np.bincount(srcind.astype(np.int)).astype(self.INT)
 
-        # compute the frobenius norm (used when calling LSQR)
-        # this could be avoided if we collect sum(aij^2) along the way
-        self.frob=np.sqrt(sum(a*a for a in aij))
+        # compute the frobenius norm (used when calling LSQR) and the
+        # column norms, which were collected along the way
+        self.frob=self.stats.frob
+        self.colsumsq=self.stats.colsumsq[self.juniq]
+        self.imgnnz=np.array(self.stats.imgnnz,dtype=self.INT)
 
 
         
-        # ok... finally... Package up the matrix as a coo_matrix
-        self.A=ssl.aslinearoperator(coo_matrix((aij,(self.icomp,self.jcomp)),
-                                               shape=dim))
+        # ok... finally... Package up the matrix as a sparse operator
+        if self.outofcore:
+            self.A=DiskOperator(store.filename,juniq=self.juniq,scratch=True)
+        else:
+            self.A=SparseOperator(aij,self.icomp,self.jcomp,dim,
+                                  precision=self.precision)
 
 
 
@@ -163,7 +232,7 @@ class Matrix(object):
         #dim=np.array([max(iic),max(jjc)])+1
         
         # compute the density of this matrix
-        self.density=float(self.A.A.nnz)/(float(dim[0])*float(dim[1]))
+        self.density=float(self.stats.nnz)/(float(dim[0])*float(dim[1]))
 
         # now we want to create an Lcurve for this matrix
         self.lcurve=LCurve(norm=self.frob)
@@ -171,7 +240,7 @@ class Matrix(object):
 
     def __len__(self):
         if hasattr(self,'A'):
-            return self.A.A.nnz
+            return self.A.nnz
         else:
             return 0
         
@@ -208,85 +277,104 @@ class Matrix(object):
     #                
     #    return i,j,aij,bi
     
-    def load_from_images(self,grisms,sources,extbeams,mskbeams):
+    def load_from_images(self,grisms,sources,extbeams,mskbeams,store=None):
         msg='[info]Building the matrix: {} images, {} sources.'
         print(msg.format(self.nimg,self.nsrc))
 
-        
-        # make a progress bar
-        pb=tqdm.tqdm(total=self.nimg,desc='Loading ODTs',dynamic_ncols=True)
-
         # open a file to write to
         # data to save as the matrix content
-        i,j,aij,bi=[],[],[],[]
-
-        # process each grism image        
-        for grism in grisms:
-            pb.update()     # update the progess bar
-            
-            # load the data from a single grism image
-            data=self.load_grism(grism,sources,extbeams,mskbeams)
-                        
-            # collect the matrix values
-            if len(data[0]) > 0:
-                i.extend(data[0])
-                j.extend(data[1])
-                aij.extend(data[2])
-                bi.extend(data[3])
-
-        # retype things
-        i=np.array(i,dtype=self.INT)
-        j=np.array(j,dtype=self.INT)
-        aij=np.array(aij,dtype=self.FLOAT)
-        bi=np.array(bi,dtype=self.FLOAT)
-
-        return i,j,aij,bi
+        ijaij=Accumulator(self.INT,self.INT,self.FLOAT)
+        bi=Accumulator(self.FLOAT)
 
+        # the statistics of the matrix
+        self.stats=Statistics(self.npar)
+        
+        # the grism images are independent, so tag each with its index
+        units=list(enumerate(grisms))
 
+        # make the things shared by the grism images before the workers
+        # are made, so they are not remade by each worker
+        self.prepare_grisms(grisms,extbeams,mskbeams)
         
-    def make_beam_mask(self,h5tab,sources,device,mskbeams,min_rate=1e-2):
-        ''' compute a mask to exclude pixels associated with other beams '''
+        # make a pool, which also makes a progress bar.  The workers get
+        # a copy of the matrix with only what is needed to load a grism
+        pool=Pool(load_grism_unit,ncpu=self.ncpu,desc='Loading ODTs')
+
+        # collect the results in the order of the grisms, holding any
+        # that finish early until their turn
+        pending={}
+        nextindex=0
+        loader=self.loader()
+        for index,data in pool.stream(units,loader,sources,extbeams,mskbeams):
+            pending[index]=data
+            while nextindex in pending:
+                data=pending.pop(nextindex)
+                nextindex+=1
                 
-        # get the photflam
-        photflam=sources.obscat.detband.photflam
-        
-        # make output beam amsk
-        beam_mask=np.zeros([device.naxis2,device.naxis1],dtype=bool)
-
-        # load the config
-        configs=[device.load_beam(beam) for beam in mskbeams]
-
-        # process each source
-        for source in sources:
-            # the notional flux of a source
-            flam=source.total*photflam
-
-            # process each beam
-            for config in configs:
+                # set the image dimensions, and make sure it's fixed
+                imgdim=data[5]
+                if imgdim is None:
+                    continue
+                if self.imgdim is None:
+                    self.imgdim=imgdim
+                elif self.imgdim!=imgdim:
+                    raise RuntimeError("Detector size must not change.")
 
-                # open the OMT
-                h5tab.open_table(device.name,config.beam,'omt')
-                
-                # a notional peak count rate in a grism image
-                count_rate=flam*config.sensitivity.smax
+                # collect the matrix values, offsetting the image index
+                npix=self.INT(imgdim[0])*self.INT(imgdim[1])
+                self.stats.update(data[0],data[1],data[2],npix,len(data[4]))
+                if len(data[0]) > 0:
+                    offset=npix*self.INT(len(self.images))
+                    if store is None:
+                        ijaij.extend(data[0]+offset,data[1],data[2])
+                        bi.extend(data[3])
+                    else:
+                        store.append(data[0]+offset,data[1],data[2],data[3])
+                self.images.extend(data[4])
+                del data
+
+        # join the chunks
+        if store is not None:
+            return None,None,None,None
+        i,j,aij=ijaij.to_numpy()
+        bi=bi.to_numpy()
 
-                # only mask the pixels if the source is bright enough
-                if count_rate > min_rate:
+        return i,j,aij,bi
 
-                    # read the OMT
-                    #omt=h5tab.load_from_file(source.name,'omt',config.beam)
-                    omt=h5tab.load_from_file(source,config.beam,'omt')
-                    
-                    # put values in beam_mask
-                    beam_mask[omt.y.to_numpy(),omt.x.to_numpy()]=True
+    def prepare_grisms(self,grisms,extbeams,mskbeams):
+        ''' make the beam masks, pixel-area maps and tabulated flat fields,
+            which are saved (or kept) for the grism images to share '''
 
-        return beam_mask
-        
+        for grism in grisms:
+            with h5table.H5Table(grism.dataset,path=self.path,
+                                 mode='r') as h5tab:
+                for device in grism:
+                    if mskbeams:
+                        self.beammask.prepare(h5tab,device)
+                    device.pixel_area_image(path=self.path)
+                    if self.flatdwav:
+                        for beam in extbeams:
+                            beamconf=device.load_beam(beam)
+                            flatfield=beamconf.load_flatfield(dwav=self.flatdwav)
+                            flatfield.prepare()
+
+    def loader(self):
+        ''' a copy of the matrix with only what load_grism needs '''
+        obj=Matrix()
+        for k in ('path','kernel','flatdwav','beammask','npar','cwav'):
+            setattr(obj,k,getattr(self,k))
+        return obj
         
     def load_grism(self,grism,sources,extbeams,mskbeams):
 
         # stuff to output
-        i,j,aij,bi=[],[],[],[]
+        ijaij=Accumulator(self.INT,self.INT,self.FLOAT)
+        bi=Accumulator(self.FLOAT)
+
+        # the images in this grism.  The image indices in the matrix are
+        # local to this grism, which are offset by the caller
+        images=[]
+        imgdim=None
         
         # open the ODT file
         dataset=grism.dataset
@@ -305,17 +393,16 @@ class Matrix(object):
                 # update the mask with the beams
                 #if mskbeams is not None and mskbeams:
                 if mskbeams:
-                    msk |= self.make_beam_mask(h5tab,sources,device,mskbeams)
+                    msk |= self.beammask(h5tab,device)
 
                 # total number of pixels in the image
                 npix=self.INT(device.naxis1)*self.INT(device.naxis2)
 
 
                 # set the image dimensions, and make sure it's fixed
-                imgdim=(device.naxis1,device.naxis2)
-                if self.imgdim is None:
-                    self.imgdim=imgdim
-                elif self.imgdim!=imgdim:
+                if imgdim is None:
+                    imgdim=(device.naxis1,device.naxis2)
+                elif imgdim!=(device.naxis1,device.naxis2):
                     raise RuntimeError("Detector size must not change.")
                     
                 # load the right device
@@ -325,12 +412,12 @@ class Matrix(object):
                 config={}
                 for beam in extbeams:
                     beamconf=device.load_beam(beam)
-                    flatfield=beamconf.load_flatfield()
+                    flatfield=beamconf.load_flatfield(dwav=self.flatdwav)
                     config[beam]=(beamconf,flatfield)
 
 
                 # container for the xy pairs
-                xygp=[]
+                xygp=Accumulator(self.INT)
 
 
                 
@@ -367,7 +454,7 @@ class Matrix(object):
                         xyg=x+device.naxis1*y
                         
                         # compute 2d matrix coordinates
-                        imgindex=self.INT(len(self.images))
+                        imgindex=self.INT(len(images))
                         ii=xyg+npix*imgindex
                         jj=lamind+self.cwav[kk]
                         
@@ -406,9 +493,7 @@ class Matrix(object):
                         #    (aij,(iu,ju)) for the matrix
                         #     biu for the vector
                         # so let's package them for output
-                        i.extend(iu)
-                        j.extend(ju)
-                        aij.extend(aiju)
+                        ijaij.extend(iu,ju,aiju)
                         #bi.extend(biu)
                         xygp.extend(xygu)
 
@@ -416,7 +501,7 @@ class Matrix(object):
                 ########################################################
 
                 # make into a numpy array
-                xygp=np.array(xygp)
+                xygp=xygp.to_numpy()
                 
                 # ok, now get the values for the vector
                 # from the unique grism pixel pairs (xygp)
@@ -443,11 +528,12 @@ class Matrix(object):
                 #h5tab.close_device()
                 
                 # update the images list
-                self.images.append((dataset,device.name))
+                images.append((dataset,device.name))
 
 
         # return the matrix data
-        return i,j,aij,bi
+        i,j,aij=ijaij.to_numpy()
+        return i,j,aij,bi.to_numpy(),images,imgdim
 
                     
 
@@ -489,10 +575,10 @@ class Matrix(object):
                 g=np.where((ddt.wav >= wav0) & (ddt.wav <= wav1))[0]
                 ddt.select(g)
                         
-                # just for streamlined access
-                x=ddt.x.to_numpy()
-                y=ddt.y.to_numpy()
-                wav=ddt.wav.to_numpy()
+                # just for streamlined access (views, only the values are scaled)
+                x=ddt.x.view
+                y=ddt.y.view
+                wav=ddt.wav.view
 
 
                 
@@ -503,7 +589,7 @@ class Matrix(object):
                 #           given as a wave-depend. thing)
                 s=beamconf.sensitivity(wav)*FLUXSCALE
                 f=flatfield(x,y,wav)
-                p=device.pixel_area_map(x,y)
+                p=device.pixel_area_map(x,y,path=self.path)
                                 
                 # scale the DDT
                 ddt*=(s*f*p)
@@ -560,14 +646,153 @@ class Matrix(object):
         self.target=target
         self.bi-=self.A.matvec(self.target)
 
+        # the bidiagonalization and solutions depend on the vector
+        self.gkb=None
+        self.solutions=[]
+
+    def column_sumsq(self):
+        ''' the sum of the squares of each column '''
+        ai2=getattr(self,'colsumsq',None)
+        if ai2 is None:
+            ai2=self.A.column_sumsq()
+        return ai2
+        
+    def column_scales(self,damp=0.):
+        ''' the right-diagonal preconditioner that equilibrates the columns
+            of the damped matrix [A;damp*I] '''
+
+        # equilibrating A alone is badly scaled once the damping dominates
+        # the column norms, so the damping enters the norms.  Then the
+        # scales are uniform (and have no effect) for large damping
+        ai2=self.column_sumsq()+damp*damp
+        scale=np.ones_like(ai2)
+        np.divide(1.,np.sqrt(ai2),out=scale,where=(ai2>0))
+        return scale
+    
+    def warm_solve(self,solver,damp,**kwargs):
+        ''' call LSQR/LSMR, starting from the nearest converged solution 
+            and with an optional column preconditioner '''
+
+        # find the nearest solution in log(damp)
+        x0=None
+        if getattr(self,'warmstart',False) and getattr(self,'solutions',None):
+            logdamp=np.log10(max(damp,1e-300))
+            dist=[abs(np.log10(max(d,1e-300))-logdamp)
+                  for d,x,itn in self.solutions]
+            x0=self.solutions[int(np.argmin(dist))][1]
+
+        # the column preconditioner
+        if getattr(self,'precondition',False):
+            d=self.column_scales(damp)
+        else:
+            d=None
+            
+        if x0 is None and d is None:
+            # a cold start
+            r=solver(self.A,self.bi,damp=damp,**kwargs)
+            x,itn=r[0],r[2]
+        else:
+            # solve for the correction (dx=D.z) to x0 with the residual
+            # correction formulation:
+            #     min ||[A.D;damp*D].z - [b-A.x0;-damp*x0]||
+            # which is the damped problem for x=x0+D.z.  D is the
+            # diagonal preconditioner (or the identity), which leaves
+            # the damping of x unchanged.
+            m,n=self.A.shape
+            dd=np.ones(n,dtype=np.float64) if d is None else d
+            xx=np.zeros(n,dtype=np.float64) if x0 is None else x0
+            matvec=lambda v: self.A.matvec(dd*v)
+            rmatvec=lambda u: dd*self.A.rmatvec(u)
+            rhs=self.bi-self.A.matvec(xx)
+            if damp>0:
+                matvec=lambda v: np.concatenate((self.A.matvec(dd*v),
+                                                 damp*dd*v))
+                rmatvec=lambda u: dd*(self.A.rmatvec(u[:m])+damp*u[m:])
+                rhs=np.concatenate((rhs,-damp*xx))
+            A=ssl.LinearOperator((len(rhs),n),matvec=matvec,rmatvec=rmatvec,
+                                 dtype=np.float64)
+            
+            # the relative tolerance on the residual is w.r.t. the new
+            # right-hand side, so rescale it to that of the cold start
+            rnorm=np.linalg.norm(rhs)
+            if rnorm>0:
+                btol=kwargs.pop('btol',1e-6)
+                kwargs['btol']=btol*np.linalg.norm(self.bi)/rnorm
+
+            r=solver(A,rhs,damp=0.,**kwargs)
+            x=xx+dd*r[0]
+            itn=r[2]
+
+            # the norms of the damped problem.  The residual of the
+            # correction is that of the damped problem for x
+            xnorm=np.linalg.norm(x)
+            if solver is ssl.lsqr:
+                r1norm=np.linalg.norm(self.bi-self.A.matvec(x))
+                var=r[9]*dd*dd
+                r=(x,r[1],itn,r1norm,r[4],*r[5:8],xnorm,var)
+            else:
+                r=(x,r[1],itn,*r[3:7],xnorm)
+
+        # record the converged solutions
+        if getattr(self,'warmstart',False) and r[1] in (1,2,4,5):
+            self.solutions=getattr(self,'solutions',[])
+            self.solutions.append((damp,x,itn))
+        
+        return r,x0 is not None
+
 
     def invert(self,logdamp,scale=True,**kwargs):
         if self.inverter=='lsqr':
             return self.run_lsqr(logdamp,scale=scale,**kwargs)
         elif self.inverter=='lsmr':
             return self.run_lsmr(logdamp,scale=scale,**kwargs)
+        elif self.inverter=='gkb':
+            return self.run_gkb([logdamp],scale=scale,**kwargs)[0]
         else:
             raise NotImplementedError("Inverter not found.")
+
+    def invert_many(self,logdamps,scale=True,**kwargs):
+        ''' invert for many damping values '''
+        if self.inverter=='gkb':
+            return self.run_gkb(logdamps,scale=scale,**kwargs)
+        else:
+            return [self.invert(ld,scale=scale,**kwargs) for ld in logdamps]
+
+    def run_gkb(self,logdamps,scale=True,**kwargs):
+        ''' solve with a bidiagonalization shared over the dampings '''
+
+        # scale the log(damp) into a damping
+        damps=[]
+        for logdamp in logdamps:
+            if logdamp is None:
+                damp=0.
+            else:
+                damp=10.**logdamp
+                if scale:
+                    damp*=self.frob   # scale the damping by frobenius
+            damps.append(damp)
+        print('[info]Running GKB with l={}'.format(','.join(map(str,damps))))
+
+        # do the bidiagonalization once (it is extended as needed)
+        if getattr(self,'gkb',None) is None:
+            self.gkb=Bidiagonalization(self.A,self.bi,**kwargs)
+
+        # solve for each damping
+        results=[]
+        for damp,r in zip(damps,self.gkb.solve(damps)):
+
+            # take the target out
+            if self.target is not None:
+                r=(r[0]+self.target,*r[1:])
+
+            # package the outputs
+            r=Result('gkb',*r,r[-1].copy(),damp/self.frob)
+            
+            # update the Lcurve
+            self.lcurve.append(r.r1norm,r.xnorm,r.logdamp,r.itn,r.warm)
+            results.append(r)
+
+        return results
     
         
     
@@ -582,7 +807,7 @@ class Matrix(object):
         print('[info]Running LSMR with l={}'.format(damp))
         
         #t1=default_timer()
-        r=ssl.lsmr(self.A,self.bi,damp=damp,**kwargs)
+        r,warm=self.warm_solve(ssl.lsmr,damp,**kwargs)
         (x,istop,itn,normr,normar,norma,conda,normx)=r
         
         r1norm=normr
@@ -590,11 +815,11 @@ class Matrix(object):
         lo=np.zeros_like(x)
         hi=np.zeros_like(x)
         r=Result('lsmr',x,istop,itn,r1norm,r2norm,norma,conda,normar,normx,
-                 lo,hi,damp/self.frob)
+                 lo,hi,damp/self.frob,warm)
         #t2=default_timer()
         #dt=(t2-t1)/60.    # in minutes
         
-        self.lcurve.append(r.r1norm,r.xnorm,r.logdamp)
+        self.lcurve.append(r.r1norm,r.xnorm,r.logdamp,r.itn,r.warm)
 
         return r
 
@@ -614,7 +839,7 @@ class Matrix(object):
         print('[info]Running LSQR with l={}'.format(damp))
         
         #t1=default_timer()
-        r=ssl.lsqr(self.A,self.bi,damp=damp,calc_var=True,**kwargs)
+        r,warm=self.warm_solve(ssl.lsqr,damp,calc_var=True,**kwargs)
 
                 
         #atol=atol,btol=btol,conlim=conlim,iter_lim=maxiter)#
@@ -629,11 +854,11 @@ class Matrix(object):
             r=(r[0]+self.target,*r[1:])
             
         # package the outputs
-        r=Result('lsqr',*r,r[-1].copy(),damp/self.frob)
+        r=Result('lsqr',*r,r[-1].copy(),damp/self.frob,warm)
         
         
         # update the Lcurve
-        self.lcurve.append(r.r1norm,r.xnorm,r.logdamp)
+        self.lcurve.append(r.r1norm,r.xnorm,r.logdamp,r.itn,r.warm)
         
 
         return r
@@ -641,8 +866,7 @@ class Matrix(object):
 
     def estimate_uncertainty(self):
 
-        ai2,j2=indices.decimate(self.juniq[self.jcomp],
-                                self.A.A.data*self.A.A.data)
+        ai2=self.column_sumsq()
 
         # these two lines to avoid divide-by-zero errors
         unc=np.full_like(ai2,np.inf)
@@ -655,37 +879,18 @@ class Matrix(object):
     
 
     def sub_matrix(self,j,resid):
-      
-        g=np.where(self.A.A.col == j)[0]
+        ''' the column j of the matrix and the residuals of its rows '''
+
+        # the operator keeps a CSC ordering, so this is O(nnz in column)
+        ii,aij=self.A.column(j)
         
-        if len(g)==0:
+        if len(ii)==0:
             print('[warn]No valid matrix elements for column={}'.format(j))
             return None,None
-        
-        ii=self.A.A.row[g]
-        jj=self.A.A.col[g]
-        aij=self.A.A.data[g]
-        iic,iiu=indices.compress(ii)
-        jjc,jju=indices.compress(jj)
- 
-        dim=np.array([max(iic),max(jjc)])+1
-
-
-
-        #tot=np.sum(aij*aij)
-        #unc=1/np.sqrt(tot)
-
-        A=ssl.aslinearoperator(coo_matrix((aij,(iic,jjc)),shape=dim))
-        try:
-            bi=resid[iic]
-        except:
-            print(len(resid))
-            print(iic)
-            print(j)
-            print(len(iic),len(iiu))
-            import pdb
-            pdb.set_trace()
 
+        # the rows are the same in the sub-matrix and in the residuals
+        A=ssl.aslinearoperator(np.asarray(aij,dtype=self.FLOAT)[:,np.newaxis])
+        bi=resid[ii]
             
         return A,bi
 
@@ -694,19 +899,24 @@ class Matrix(object):
     def compute_model(self,xj):
         bi=self.A.matvec(xj)
 
-        npix=self.imgdim[0]*self.imgdim[1]
+        npix=self.INT(self.imgdim[0])*self.INT(self.imgdim[1])
         imgindices,pixindices=np.divmod(self.iuniq,npix)
 
-
+        # fill one buffer for all the images
         dtype=[('x',np.uint16),('y',np.uint16),('v',np.float64)]
-
+        data=np.empty(len(bi),dtype=dtype)
+        y,x=np.divmod(pixindices,self.INT(self.imgdim[0]))
+        data['x']=x
+        data['y']=y
+        data['v']=bi
+
+        # the rows are sorted by image, so split the buffer into views
+        nimg=len(self.images)
+        bounds=np.searchsorted(imgindices,np.arange(nimg+1))
+        
         out={image:{} for (image,detname) in self.images}
         for imgindex,(image,detname) in enumerate(self.images):
-            g=np.where(imgindices == imgindex)
-            
-            y,x=np.divmod(pixindices[g],self.imgdim[0])
-            data=np.array(list(zip(x,y,bi[g])),dtype=dtype)
-            out[image][detname]=data
+            out[image][detname]=data[bounds[imgindex]:bounds[imgindex+1]]
 
         return out
 
@@ -735,7 +945,7 @@ class Matrix(object):
         header_utils.add_stanza(hdr,'Matrix Properties',before='NNZ')
 
 
-    def to_hdf5(self,h5):
+    def to_hdf5(self,h5,codec='lzf'):
         name=str(self.group)
         hf=h5.require_group(str(self.group))
 
@@ -748,14 +958,13 @@ class Matrix(object):
         hf.attrs['npix']=self.npix
         hf.attrs['npar']=self.npar
         hf.attrs['density']=self.density
+        hf.attrs['precision']=self.A.precision
 
 
         # flags for writing dataset
 
         # write all the datasets
-        d=hf.create_dataset('icomp',data=self.icomp,**COMPARGS)
         d=hf.create_dataset('iuniq',data=self.iuniq,**COMPARGS)
-        d=hf.create_dataset('jcomp',data=self.jcomp,**COMPARGS)
         d=hf.create_dataset('juniq',data=self.juniq,**COMPARGS)
         d=hf.create_dataset('cwav',data=self.cwav,**COMPARGS)
         d=hf.create_dataset('lam',data=self.lam,**COMPARGS)
@@ -782,19 +991,132 @@ class Matrix(object):
             d=hf.create_dataset('target',data=self.target,**COMPARGS)
 
         d=hf.create_dataset('bi',data=self.bi,**COMPARGS)
-        dtype=[('row',self.INT),('col',self.INT),('data',self.FLOAT)]
-        data=np.array(list(zip(self.A.A.row,self.A.A.col,self.A.A.data)),
-                      dtype=dtype)
 
-        d=hf.create_dataset('aij',data=data,**COMPARGS)
-        d.attrs['shape']=self.A.A.shape
+        # the statistics of the matrix
+        d=hf.create_dataset('colsumsq',data=self.colsumsq,**COMPARGS)
+        d=hf.create_dataset('rownnz',data=self.rownnz,**COMPARGS)
+        d=hf.create_dataset('imgnnz',data=self.imgnnz,**COMPARGS)
+
+        # write the matrix as the buffers of the CSR ordering.  The rows
+        # are sorted by image, so an image is a contiguous block
+        self.write_csr(hf,codec=codec)
 
 
         # write the LCurve results
         self.lcurve.write_hdf5(hf)
+
+    def write_csr(self,hf,codec='lzf'):
+        ''' write the CSR buffers of the matrix in chunks '''
         
+        if codec not in self.CODECS:
+            raise NotImplementedError("Codec not found.")
+        
+        hd=hf.create_group('csr')
+        hd.attrs['shape']=self.A.shape
+        hd.attrs['codec']=codec
+
+        # the indices are stored as they are used in memory, so they
+        # are read without a copy
+        itype=SparseOperator.index_type(self.A.shape,self.A.nnz)
+        vtype=SparseOperator.value_type(self.A.precision)
+        dtypes={'indptr':itype,'indices':itype,'data':vtype}
+        for k,dtype in dtypes.items():
+            hd.create_dataset(k,shape=(0,),dtype=dtype,maxshape=(None,),
+                              chunks=(self.CHUNKSIZE,),**self.CODECS[codec])
+
+        # copy the blocks of rows (there is one block in memory)
+        self.append_data(hd['indptr'],np.zeros(1,dtype=itype))
+        offset=0
+        for i0,blk in self.A.blocks():
+            self.append_data(hd['indices'],blk.indices.astype(itype,copy=False))
+            self.append_data(hd['data'],blk.data.astype(vtype,copy=False))
+            self.append_data(hd['indptr'],
+                             (blk.indptr[1:]+offset).astype(itype,copy=False))
+            offset+=blk.nnz
+
+    @staticmethod
+    def append_data(hd,data):
+        ''' append to a resizable dataset '''
+        start=hd.shape[0]
+        if len(data)>0:
+            hd.resize((start+len(data),))
+            hd[start:]=data
+
+    @staticmethod
+    def read_csr(hf,rows=None):
+        ''' read the CSR buffers, optionally only for blocks of rows '''
+
+        hd=hf['csr']
+        shape=tuple(hd.attrs['shape'])
+        if rows is None:
+            return hd['data'][:],hd['indices'][:],hd['indptr'][:],shape
+
+        # read each block of rows with a single slice of the datasets
+        itype=hd['indptr'].dtype
+        data,indices=[hd['data'][:0]],[hd['indices'][:0]]
+        indptr=[np.zeros(1,dtype=itype)]
+        for r0,r1 in rows:
+            ptr=hd['indptr'][r0:r1+1]
+            data.append(hd['data'][ptr[0]:ptr[-1]])
+            indices.append(hd['indices'][ptr[0]:ptr[-1]])
+            indptr.append(ptr[1:]-ptr[0]+indptr[-1][-1])
+        nrow=sum(r1-r0 for r0,r1 in rows)
+        return np.concatenate(data),np.concatenate(indices),\
+            np.concatenate(indptr),(nrow,shape[1])
+
     @classmethod
-    def from_hdf5(cls,h5,group):
+    def read_csr_columns(cls,hf,cols,rows=None,vector=None):
+        ''' read the CSR buffers for some columns (and blocks of rows), and
+            the product of the rows with a vector (over all the columns) '''
+
+        # the CSR buffers are ordered by row, so every element of the
+        # rows is read, but only those in the columns are kept.  The
+        # rows are read in blocks of about CHUNKSIZE elements
+        hd=hf['csr']
+        shape=tuple(hd.attrs['shape'])
+        itype=hd['indptr'].dtype
+        lookup=np.full(shape[1],-1,dtype=np.int64)
+        lookup[cols]=np.arange(len(cols))
+        if rows is None:
+            rows=[(0,shape[0])]
+
+        data,indices=[hd['data'][:0]],[hd['indices'][:0]]
+        indptr=[np.zeros(1,dtype=itype)]
+        product=[np.zeros(0,dtype=np.float64)]
+        for r0,r1 in rows:
+            allptr=hd['indptr'][r0:r1+1].astype(np.int64)
+            while r0 < r1:
+                a=allptr[0]
+                n=np.searchsorted(allptr,a+cls.CHUNKSIZE,side='right')-1
+                n=min(max(n,1),r1-r0)
+                ptr,allptr=allptr[:n+1],allptr[n:]
+                dat=hd['data'][ptr[0]:ptr[-1]]
+                ind=hd['indices'][ptr[0]:ptr[-1]]
+
+                # the product with the vector over all the columns
+                if vector is not None:
+                    rowid=np.repeat(np.arange(n),np.diff(ptr))
+                    product.append(np.bincount(rowid,weights=dat*vector[ind],
+                                               minlength=n))
+
+                # keep the elements in the columns
+                j=lookup[ind]
+                keep=j>=0
+                count=np.concatenate(([0],np.cumsum(keep)))
+                data.append(dat[keep])
+                indices.append(j[keep].astype(itype))
+                count=count[ptr[1:]-ptr[0]]+indptr[-1][-1]
+                indptr.append(count.astype(itype))
+                r0+=n
+
+        nrow=sum(r1-r0 for r0,r1 in rows)
+        product=np.concatenate(product) if vector is not None else None
+        return np.concatenate(data),np.concatenate(indices),\
+            np.concatenate(indptr),(nrow,len(cols)),product
+    
+    @classmethod
+    def from_hdf5(cls,h5,group,images=None,segids=None,outofcore=False):
+        ''' load a matrix, optionally for some images and/or sources '''
         obj=cls()
         obj.group=group
         if str(obj.group) in h5:
@@ -804,9 +1126,7 @@ class Matrix(object):
                 setattr(obj,k,v)
             obj.imgdim=tuple(obj.imgdim)
             
-            obj.icomp=hf['icomp'][:]
             obj.iuniq=hf['iuniq'][:]
-            obj.jcomp=hf['jcomp'][:]
             obj.juniq=hf['juniq'][:]
             obj.lam=hf['lam'][:]
             obj.cwav=hf['cwav'][:]
@@ -816,8 +1136,8 @@ class Matrix(object):
 
             
             decode=lambda x: x.decode('UTF-8')
-            images=hf['images'][:]
-            obj.images=[(decode(dset),decode(dev)) for dset,dev in images]
+            data=hf['images'][:]
+            obj.images=[(decode(dset),decode(dev)) for dset,dev in data]
             
             
             hd=hf['ri']
@@ -831,16 +1151,93 @@ class Matrix(object):
 
             obj.bi=hf['bi'][:]
 
+            # the statistics of the matrix
+            for k in ('colsumsq','rownnz','imgnnz'):
+                if k in hf:
+                    setattr(obj,k,hf[k][:])
+
             
-            shape=hf['aij'].attrs['shape']
-            A=hf['aij'][:]
-            obj.A=ssl.aslinearoperator(coo_matrix((A['data'],
-                                                   (A['row'],A['col'])),
-                                                  shape=shape))
+            # the rows of the selected images.  An image is given by its
+            # index, its (dataset,device), or its dataset (all devices)
+            rows=None
+            if images is not None:
+                npix=obj.INT(obj.imgdim[0])*obj.INT(obj.imgdim[1])
+                indices=set()
+                for image in images:
+                    if isinstance(image,str):
+                        found=[k for k,(dset,dev) in enumerate(obj.images)
+                               if dset==image]
+                    elif isinstance(image,tuple):
+                        found=[k for k,img in enumerate(obj.images)
+                               if img==image]
+                    else:
+                        found=[int(image)]
+                    if not found:
+                        print('[warn]Image {} is not in the matrix'.format(image))
+                    indices.update(found)
+                rows=[]
+                for index in sorted(indices):
+                    r=np.searchsorted(obj.iuniq,[npix*obj.INT(index),
+                                                 npix*obj.INT(index+1)])
+                    if r[1]>r[0]:
+                        rows.append((int(r[0]),int(r[1])))
+                
+            # the columns of the selected sources.  The vector has the
+            # model of the target subtracted, so the model of the target
+            # in the other columns is put back
+            cols,vector=None,None
+            if segids is not None:
+                target=obj.target
+                cols=obj.select_sources(segids)
+                if target is not None:
+                    vector=np.array(target,dtype=np.float64)
+                    vector[cols]=0.
+                    
+            precision=getattr(obj,'precision','double')
+            product=None
+            if 'csr' in hf and outofcore and rows is None and segids is None:
+                # stream the matrix from the file
+                obj.A=DiskOperator(h5.filename,group=hf['csr'].name)
+            elif 'csr' in hf and cols is not None:
+                data,indices,indptr,shape,product=obj.read_csr_columns(hf,
+                    cols,rows=rows,vector=vector)
+                obj.A=SparseOperator.from_csr(data,indices,indptr,shape,
+                                              precision=precision)
+                del data,indices,indptr
+            elif 'csr' in hf:
+                data,indices,indptr,shape=obj.read_csr(hf,rows=rows)
+                obj.A=SparseOperator.from_csr(data,indices,indptr,shape,
+                                              precision=precision)
+                del data,indices,indptr
+            else:
+                # matrices written before the CSR datasets
+                shape=hf['aij'].attrs['shape']
+                A=hf['aij'][:]
+                obj.A=SparseOperator(A['data'],A['row'],A['col'],shape,
+                                     precision=precision)
+                del A
+                csr=obj.A.csr
+                if rows is not None:
+                    csr=csr[obj.row_indices(rows)]
+                if vector is not None:
+                    product=csr.dot(vector)
+                if cols is not None:
+                    csr=csr[:,cols]
+                obj.A.set_csr(csr,precision)
 
             # load the L-curve data and test with the other loaded frob
             obj.lcurve=LCurve.from_hdf5(hf)
-            if np.abs(obj.lcurve.norm/obj.frob-1)>1e-4:
+            if images is not None or segids is not None:
+                irow=obj.row_indices(rows) if rows is not None \
+                    else np.arange(len(obj.iuniq))
+                obj.iuniq=obj.iuniq[irow]
+                obj.bi=obj.bi[irow]
+                if product is not None:
+                    obj.bi=obj.bi+product
+                obj.select()
+                if obj.npix==0:
+                    print('[warn]The selection has no matrix elements')
+            elif np.abs(obj.lcurve.norm/obj.frob-1)>1e-4:
                 print('[warn]The frobenius norm is corrupted')
 
             return obj
@@ -849,6 +1246,61 @@ class Matrix(object):
             
 
                 
+    @staticmethod
+    def row_indices(rows):
+        ''' the indices of blocks of rows '''
+        return np.concatenate([np.arange(r0,r1,dtype=np.int64)
+                               for r0,r1 in rows]+[np.zeros(0,dtype=np.int64)])
+
+    def select_sources(self,segids):
+        ''' restrict the columns to some sources, returns the columns '''
+
+        segids=[s for s in self.segids if s in segids]
+        cols=np.sort(np.concatenate([self.ri[s] for s in segids]+
+                                    [np.zeros(0,dtype=np.int64)]))
+        cols=cols.astype(np.int64)
+        index=np.full(len(self.juniq),-1,dtype=np.int64)
+        index[cols]=np.arange(len(cols))
+
+        self.juniq=self.juniq[cols]
+        self.lam=self.lam[cols]
+        if self.target is not None:
+            self.target=self.target[cols]
+        self.ri={s:index[self.ri[s]] for s in segids}
+        self.hsrc=np.array([len(self.ri[s]) for s in segids],dtype=self.INT)
+        self.segids=np.array(segids)
+        self.nsrc=len(segids)
+        return cols
+        
+    def select(self):
+        ''' update a matrix whose rows and columns were selected '''
+
+        csr=self.A.csr
+        
+        # drop the rows without any elements
+        rownnz=np.diff(csr.indptr)
+        keep=np.where(rownnz>0)[0]
+        if len(keep)!=csr.shape[0]:
+            csr=csr[keep]
+        self.A.set_csr(csr,self.A.precision)
+
+        # update the row data
+        self.iuniq=self.iuniq[keep]
+        self.bi=self.bi[keep]
+        self.rownnz=np.diff(csr.indptr)
+        npix=self.INT(self.imgdim[0])*self.INT(self.imgdim[1])
+        imgindex=(self.iuniq//npix).astype(np.intp)
+        self.imgnnz=np.bincount(imgindex,weights=self.rownnz,
+                                minlength=len(self.images)).astype(self.INT)
+
+        # update the statistics
+        self.npix,self.npar=csr.shape
+        self.colsumsq=self.A.column_sumsq()
+        self.frob=np.sqrt(np.sum(self.colsumsq))
+        size=float(self.npix)*float(self.npar)
+        self.density=float(csr.nnz)/size if size>0 else 0.
+        self.lcurve=LCurve(norm=self.frob)
+        
     #def write_pickle(self,filename):
     #    print('[info]Pickling the matrix to: {}'.format(filename))
     #    with open(filename,'wb') as fp:
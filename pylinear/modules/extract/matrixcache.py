@@ -0,0 +1,210 @@
+import os
+import glob
+import hashlib
+import numpy as np
+import h5py
+
+from ... import h5table
+from ...grism.config.filecache import file_hash
+
+
+class MatrixCache(object):
+    ''' a content-addressed cache of the matrices on disk '''
+
+    # bump this when the layout of the matrix files changes
+    VERSION='1'
+
+    # default size of the cache (in GB)
+    MAXSIZE=10.
+
+    def __init__(self,path='matrices',maxsize=None):
+        self.path=path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # max number of bytes in the cache (<=0 means no limit)
+        maxsize=self.MAXSIZE if maxsize is None else maxsize
+        self.maxsize=float(maxsize)*1024.**3
+
+        # the keys used in this session, which are never evicted
+        self.used=set()
+
+    def filename(self,key):
+        return os.path.join(self.path,'{}.h5'.format(key))
+
+    def tempname(self,key):
+        return os.path.join(self.path,'{}.{}.tmp'.format(key,os.getpid()))
+
+    def __contains__(self,key):
+        return os.path.isfile(self.filename(key))
+
+    def load_tables(self,grisms,beams,path,mskbeams=None):
+        ''' hash the inputs common to all the groups (once per run) '''
+
+        mskbeams=mskbeams if mskbeams else []
+        tables={}
+        for grism in grisms:
+            tables[grism.dataset]=self.grism_hash(grism,beams,mskbeams,path)
+        return tables
+
+    def key(self,grisms,sources,beams,tables,mskbeams=None,kernel=None,
+            precision='double',beammask=None,flatdwav=None):
+        ''' hash the inputs to the matrix for a group of sources,
+            where tables is from load_tables() '''
+
+        mskbeams=mskbeams if mskbeams else []
+        flatdwav=flatdwav if flatdwav else None
+        sha=hashlib.sha1(self.VERSION.encode())
+        sha.update(str((list(beams),list(mskbeams),precision)).encode())
+
+        # an approximate (tabulated) flat field changes the matrix
+        if flatdwav is not None:
+            sha.update(str(('flatdwav',float(flatdwav))).encode())
+
+        # the convolution kernel
+        if kernel is not None:
+            sha.update(kernel.fingerprint().encode())
+
+        # the beam masks, which are made from all the sources
+        if beammask is not None:
+            sha.update(beammask.signature.encode())
+
+        # the sources (with their SEDs, which set the damping target)
+        photflam=getattr(getattr(sources,'obscat',None),'detband',None)
+        sha.update(str(getattr(photflam,'photflam',None)).encode())
+        for source in sources:
+            sha.update(self.source_hash(source).encode())
+
+        # the grism images and the tables of these sources
+        segids=[source.segid for source in sources]
+        for grism in grisms:
+            common,pdts=tables[grism.dataset]
+            sha.update(common.encode())
+            for fps in pdts:
+                for segid in segids:
+                    sha.update(str(fps.get(segid)).encode())
+        return sha.hexdigest()
+
+    def source_hash(self,source):
+        ''' hash the properties of a source that enter the matrix '''
+
+        sha=hashlib.sha1(str(source.segid).encode())
+        sha.update(np.asarray(source.xd,dtype=np.int64).tobytes())
+        sha.update(np.asarray(source.yd,dtype=np.int64).tobytes())
+        sha.update(np.asarray(source.wht,dtype=np.float64).tobytes())
+        sha.update(str((source.total,source.lamb0,source.lamb1,
+                        source.dlamb)).encode())
+        if hasattr(source,'sed'):
+            sha.update(np.asarray(source.sed.lamb,dtype=np.float64).tobytes())
+            sha.update(np.asarray(source.sed.flam,dtype=np.float64).tobytes())
+        return sha.hexdigest()
+
+    def grism_hash(self,grism,beams,mskbeams,path):
+        ''' hash the images, calibration files and tables of a grism
+            exposure, and collect the fingerprints of its PDTs '''
+
+        sha=hashlib.sha1(grism.dataset.encode())
+
+        # the images, which are identified by their size and time stamp,
+        # and the calibration files of the beams
+        for devname,device in grism.items():
+            sha.update(str((devname,device.naxis1,device.naxis2,
+                            device.bitmask)).encode())
+            sha.update(self.file_stamp(getattr(device,'filename',None)))
+            for beam in list(beams)+list(mskbeams):
+                sha.update(self.calib_hash(device.load_beam(beam)).encode())
+
+        # the tables, which are identified by their fingerprints
+        pdts=[]
+        tables=[(beam,'pdt') for beam in beams]+\
+            [(beam,'omt') for beam in mskbeams]
+        h5tab=h5table.H5Table(grism.dataset,path=path,mode='r')
+        if not os.path.isfile(h5tab.filename):
+            sha.update(b'missing')
+            return sha.hexdigest(),pdts
+        with h5tab:
+            for devname,device in grism.items():
+                for beam,ttype in tables:
+                    try:
+                        h5tab.open_table(devname,beam,ttype)
+                        fps=h5tab.load_fingerprints()
+                    except KeyError:
+                        fps={}
+
+                    # tables made before the fingerprints were recorded
+                    # can only be identified by the file
+                    if not fps:
+                        sha.update(self.file_stamp(h5tab.filename))
+                    elif ttype=='omt':
+                        # the masks depend on all the sources
+                        for segid in sorted(fps.keys()):
+                            sha.update(str((segid,fps[segid])).encode())
+                    else:
+                        # the PDTs are hashed for the sources in a group
+                        pdts.append(fps)
+        return sha.hexdigest(),pdts
+
+    @staticmethod
+    def calib_hash(beamconf):
+        ''' hash the grism configuration, sensitivity and flat field '''
+
+        sensitivity=getattr(beamconf,'sensitivity',None)
+        files=(beamconf.conffile,getattr(sensitivity,'sensfile',None),
+               getattr(beamconf,'ffname',None))
+        sha=hashlib.sha1()
+        for filename in files:
+            if filename is None or not os.path.isfile(filename):
+                sha.update(b'missing')
+            else:
+                sha.update(file_hash(filename).encode())
+        return sha.hexdigest()
+
+    @staticmethod
+    def file_stamp(filename):
+        if filename is None or not os.path.isfile(filename):
+            return b'missing'
+        stat=os.stat(filename)
+        return str((filename,stat.st_mtime_ns,stat.st_size)).encode()
+
+    def touch(self,key):
+        ''' mark a matrix as recently used '''
+        self.used.add(key)
+        os.utime(self.filename(key))
+
+    def commit(self,key):
+        ''' move a newly written matrix into the cache '''
+
+        tmpfile=self.tempname(key)
+        if not os.path.isfile(tmpfile):
+            return
+
+        # only keep files that hold a matrix
+        with h5py.File(tmpfile,'r') as h5:
+            valid=len(h5.keys())>0
+        if valid:
+            os.replace(tmpfile,self.filename(key))
+            self.used.add(key)
+            self.evict()
+        else:
+            os.remove(tmpfile)
+
+    def evict(self):
+        ''' remove the least-recently used matrices beyond the max size '''
+
+        if self.maxsize<=0:
+            return
+
+        files=[]
+        for filename in glob.glob(os.path.join(self.path,'*.h5')):
+            stat=os.stat(filename)
+            files.append((stat.st_mtime,stat.st_size,filename))
+        total=sum(f[1] for f in files)
+
+        for mtime,size,filename in sorted(files):
+            if total<=self.maxsize:
+                break
+            key=os.path.splitext(os.path.basename(filename))[0]
+            if key not in self.used:
+                print('[info]Evicting matrix from cache: {}'.format(key))
+                os.remove(filename)
+                total-=size
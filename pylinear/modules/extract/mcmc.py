@@ -5,6 +5,8 @@ from ...utilities import pool
 
 
 class MCMC(object):
+    CHUNKSIZE=1000     # number of columns to slice for each call of the pool
+
     def __init__(self,burnfrac=0.1,nstep=100,nwalker=10):
         self.burnfrac=burnfrac
         self.nstep=nstep
@@ -50,9 +52,8 @@ class MCMC(object):
         
         return lo,hi,sig
 
-    def __start_mcmc__(self,data,matrix,resid):
-        j,sig=data[0],data[1]
-        A,bi=matrix.sub_matrix(j,resid)
+    def __start_mcmc__(self,data):
+        sig,A,bi=data
         lo,hi,rms=self.sample(A,bi,sig)
         return lo,hi,rms
   
@@ -62,14 +63,21 @@ class MCMC(object):
         self._executed=True
 
         
-        # variables to iterate on
-        iters=[(j,sig) for j,sig in enumerate(result.lo)]
-
         # compute the residuals
         resid=matrix.bi-matrix.A.matvec(result.x)
 
-        # run the Pool
-        unc=self.pool(iters,matrix,resid)
+        # variables to iterate on.  Slice the columns here (with the
+        # column index of the matrix), so the matrix is not sent to
+        # the workers for every unknown.  The columns are sliced in
+        # chunks, so only CHUNKSIZE sub-matrices are held at once
+        unc=[]
+        for j0 in range(0,len(result.lo),self.CHUNKSIZE):
+            sigs=result.lo[j0:j0+self.CHUNKSIZE]
+            iters=[(sig,*matrix.sub_matrix(j,resid)) for j,sig in
+                   enumerate(sigs,start=j0)]
+
+            # run the Pool
+            unc.extend(self.pool(iters))
         #unc=[self.__start_mcmc__(itr,matrix,resid) for itr in iters]
         unc=list(zip(*unc))
 
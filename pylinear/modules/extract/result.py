@@ -18,6 +18,7 @@ class Result(object):
     lo: np.ndarray=field(default = np.zeros(0))
     hi: np.ndarray=field(default = np.zeros(0))
     damp: float=1.0
+    warm: bool=False
 
 
     @property
@@ -53,6 +54,8 @@ class Result(object):
                 comment='stopping condition')
         hdr.set('ITER',value=self.itn,after='ISTOP',
                 comment='number of iterations')
+        hdr.set('WARM',value=self.warm,after='ITER',
+                comment='was warm started')
         hdr.set('',value='',before='INVERTER')
         hdr.set('',value='      / Linear Results',before='INVERTER')
         hdr.set('',value='',before='INVERTER')
@@ -0,0 +1,131 @@
+import numpy as np
+import scipy.sparse.linalg as ssl
+from scipy.sparse import coo_matrix,csr_matrix
+
+
+class SparseOperator(ssl.LinearOperator):
+    ''' a sparse matrix with fast products in both directions '''
+
+    # number of elements upcast at a time for a single-precision matrix
+    BLOCKSIZE=2**20
+
+    def __init__(self,data,row,col,shape,precision='double'):
+        shape=tuple(int(s) for s in shape)
+        itype=self.index_type(shape,len(data))
+        vtype=self.value_type(precision)
+
+        # keep both orderings of the matrix
+        coo=coo_matrix((np.asarray(data,dtype=vtype),
+                        (np.asarray(row,dtype=itype),
+                         np.asarray(col,dtype=itype))),shape=shape)
+        csr=coo.tocsr()
+        del coo
+        self.set_csr(csr,precision)
+
+    @classmethod
+    def from_csr(cls,data,indices,indptr,shape,precision='double'):
+        ''' build from the buffers of a CSR matrix (without a COO copy) '''
+        obj=cls.__new__(cls)
+        shape=tuple(int(s) for s in shape)
+        itype=cls.index_type(shape,len(data))
+        vtype=cls.value_type(precision)
+        csr=csr_matrix((np.asarray(data,dtype=vtype),
+                        np.asarray(indices,dtype=itype),
+                        np.asarray(indptr,dtype=itype)),shape=shape)
+        obj.set_csr(csr,precision)
+        return obj
+
+    @staticmethod
+    def index_type(shape,nnz):
+        ''' use 32-bit indices when they fit '''
+        if max(max(shape),nnz) < np.iinfo(np.int32).max:
+            return np.int32
+        else:
+            return np.int64
+
+    @staticmethod
+    def value_type(precision):
+        ''' the precision of the stored values '''
+        if precision=='single':
+            return np.float32
+        elif precision=='double':
+            return np.float64
+        else:
+            raise NotImplementedError("Precision not found.")
+
+    def set_csr(self,csr,precision):
+        self.precision=precision
+        itype=self.index_type(csr.shape,csr.nnz)
+
+        # keep both orderings of the matrix
+        self.csr=csr
+        self.csc=self.csr.tocsc()
+        for mat in (self.csr,self.csc):
+            mat.indices=mat.indices.astype(itype,copy=False)
+            mat.indptr=mat.indptr.astype(itype,copy=False)
+
+        # the products are always accumulated in double precision
+        super().__init__(np.float64,csr.shape)
+
+    @property
+    def nnz(self):
+        return self.csr.nnz
+
+    @property
+    def data(self):
+        return self.csr.data
+
+    def tocoo(self):
+        return self.csr.tocoo()
+
+    def blocks(self):
+        ''' iterate over the blocks of rows (here, a single block) '''
+        yield 0,self.csr
+
+    def _product(self,mat,x):
+        ''' multiply, accumulating the products in double precision '''
+
+        x=np.asarray(x,dtype=np.float64)
+        if mat.dtype==np.float64:
+            return mat.dot(x)
+
+        # a single-precision matrix is upcast a block of rows (of about
+        # BLOCKSIZE elements) at a time, so it is never held in double
+        nrow=mat.shape[0]
+        y=np.empty((nrow,)+x.shape[1:],dtype=np.float64)
+        i0=0
+        while i0 < nrow:
+            a=mat.indptr[i0]
+            i1=np.searchsorted(mat.indptr,a+self.BLOCKSIZE,side='right')-1
+            i1=min(max(i1,i0+1),nrow)
+            b=mat.indptr[i1]
+            blk=csr_matrix((mat.data[a:b].astype(np.float64),
+                            mat.indices[a:b],mat.indptr[i0:i1+1]-a),
+                           shape=(i1-i0,mat.shape[1]))
+            y[i0:i1]=blk.dot(x)
+            i0=i1
+        return y
+
+    def _matvec(self,x):
+        return self._product(self.csr,x)
+
+    def _rmatvec(self,x):
+        # the transpose of the CSC ordering is a CSR matrix (no copy)
+        return self._product(self.csc.T,x)
+
+    def _matmat(self,X):
+        return self._matvec(X)
+
+    def column_sumsq(self):
+        ''' sum of the squares of the elements in each column '''
+
+        data=self.csc.data.astype(np.float64)
+        ncol=np.diff(self.csc.indptr)
+        col=np.repeat(np.arange(self.shape[1]),ncol)
+        return np.bincount(col,weights=data*data,minlength=self.shape[1])
+
+    def column(self,j):
+        ''' the rows and values of the non-zero elements of a column '''
+
+        a,b=self.csc.indptr[j],self.csc.indptr[j+1]
+        return self.csc.indices[a:b],self.csc.data[a:b]
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class Statistics(object):
+    ''' summary statistics of the matrix, collected as the triplets stream in '''
+    
+    def __init__(self,ncol):
+        self.nnz=0                                  # number of elements
+        self.sumsq=0.                               # = frob^2
+        self.colsumsq=np.zeros(ncol,dtype=np.float64)  # sum(aij^2) over i
+        self.colnnz=np.zeros(ncol,dtype=np.int64)      # nnz for each column
+        self.imgnnz=[]                              # nnz for each image
+        self.rowlist=[]                             # rows with elements
+        self.rownnzlist=[]                          # nnz for each row
+
+    def update(self,i,j,aij,npix,nimg):
+        ''' update with triplets whose row indices are local to nimg images '''
+
+        a2=aij*aij
+        self.nnz+=len(aij)
+        self.sumsq+=np.sum(a2)
+        self.colsumsq+=np.bincount(j.astype(np.intp),weights=a2,
+                                   minlength=len(self.colsumsq))
+        self.colnnz+=np.bincount(j.astype(np.intp),
+                                 minlength=len(self.colnnz))
+        imgindex=(i//npix).astype(np.intp)
+
+        # the rows are offset by the images before these, so they are
+        # global and sorted
+        iuniq,rownnz=np.unique(i,return_counts=True)
+        self.rowlist.append(iuniq+npix*len(self.imgnnz))
+        self.rownnzlist.append(rownnz)
+        self.imgnnz.extend(np.bincount(imgindex,minlength=nimg))
+
+    @property
+    def rows(self):
+        return np.concatenate([np.zeros(0,dtype=np.uint64)]+self.rowlist)
+
+    @property
+    def rownnz(self):
+        return np.concatenate([np.zeros(0,dtype=np.int64)]+self.rownnzlist)
+
+    @property
+    def frob(self):
+        return np.sqrt(self.sumsq)
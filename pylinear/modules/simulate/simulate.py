@@ -73,10 +73,10 @@ class Simulate(object):
                     # decimate
                     ddt=odt.decimate(*naxis)
 
-                    # get a few things
-                    x=ddt.x.to_numpy()
-                    y=ddt.y.to_numpy()
-                    wav=ddt.wav.to_numpy()
+                    # get a few things (views, only the values are scaled)
+                    x=ddt.x.view
+                    y=ddt.y.view
+                    wav=ddt.wav.view
 
                     # need to apply several things:
                     # 1. sensitivity curve
@@ -91,7 +91,7 @@ class Simulate(object):
                     ff=flatfield(x,y,wav)
 
                     # compute the pixel area
-                    area=device.pixel_area_map(x,y)
+                    area=device.pixel_area_map(x,y,path=self.path)
 
                     # compute the spectrum at some point
                     flam=source.sed.interpolate(wav)
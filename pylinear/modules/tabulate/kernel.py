@@ -1,3 +1,4 @@
+import hashlib
 import numpy as np
 from scipy.integrate import dblquad
 from timeit import default_timer
@@ -35,6 +36,12 @@ class Kernel(object):
     def __len__(self):
         return len(self.dx)
 
+    def fingerprint(self):
+        ''' hash the offsets and weights of the kernel '''
+        sha=hashlib.sha1(np.asarray(self.dx,dtype=np.int64).tobytes())
+        sha.update(np.asarray(self.dy,dtype=np.int64).tobytes())
+        sha.update(np.asarray(self.value,dtype=np.float64).tobytes())
+        return sha.hexdigest()
 
     def as_image(self):
         x0,y0=np.amin(self.dx),np.amin(self.dy)
@@ -1,8 +1,10 @@
 import os
+import hashlib
 import numpy as np
 
 from ... import h5table
 from ...utilities import Pool
+from ...grism.config.filecache import file_hash
 from .kernel import Kernel
 
 class Tabulate(object):
@@ -12,7 +14,11 @@ class Tabulate(object):
     DX=np.array([0,0,1,1],dtype=np.float)
     DY=np.array([0,1,1,0],dtype=np.float)
 
-    def __init__(self,ttype,path='tables',nsub=10,remake=True,ncpu=None):
+    # max number of polygons to drizzle in a single call
+    MAXPOLY=2**20
+
+    def __init__(self,ttype,path='tables',nsub=10,remake=True,ncpu=None,
+                 chunksize=None):
         # set the path for where the tables will be stored
         self.path=path
         if not os.path.isdir(self.path):
@@ -30,91 +36,105 @@ class Tabulate(object):
             print("[warn]Nsub should probably be >{}".format(nsub))
         self.nsub=nsub
 
-        # set the flag to remake things
+        # set the flag to remake things.  If not remaking, then only the
+        # tables whose inputs have changed (or are missing) are made
         self.remake=remake
 
         # record the CPU usage
         self.ncpu=ncpu
 
+        # number of sources in a unit of work (None=optimize)
+        self.chunksize=chunksize
+
 
     def make_pdts(self,src,wav,beamconf,device,pixfrac=1.0,kernel=None):
-        #sigma=None,nsigma=15.):
         dwav=wav[1]-wav[0]    # compute bandwidth
 
-        # make a table to write to
-        #odt=h5table.ODT(src.name,beamconf.beam,wav)
-
-        pdts=[]
         # compute ratio of pixel area between the FLT and the source
         pixrat=device.pixelarea/(pixfrac*src.pixelarea)
 
-        
-        # process each pixel in the source
-        for xd,yd,wd in src:
-
-            # convert the corners of the direct image to the
-            # corresponding grism image
-            xg,yg=src.xy2xy(xd+self.DX,yd+self.DY,device)
+        # convert the corners of all the pixels in the direct image to
+        # the corresponding grism image
+        xd=src.xd[:,np.newaxis]+self.DX
+        yd=src.yd[:,np.newaxis]+self.DY
+        xg,yg=src.xy2xy(xd.ravel(),yd.ravel(),device)
+        xg=np.reshape(xg,xd.shape)
+        yg=np.reshape(yg,yd.shape)
+
+        # drizzle the pixels in chunks, which bounds the memory
+        nchunk=max(self.MAXPOLY//len(wav),1)
+        pix,x,y,l,v=[],[],[],[],[]
+        for i in range(0,len(src),nchunk):
+            data=beamconf.drizzle_pixels(xg[i:i+nchunk],yg[i:i+nchunk],wav,
+                                         pixfrac=pixfrac,band=self.filtname)
+            pix.append(data[0]+i)
+            x.append(data[1])
+            y.append(data[2])
+            l.append(data[3])
+            v.append(data[4])
+        pix=np.concatenate(pix)
+        if len(pix)==0:
+            return
+        x=np.concatenate(x)
+        y=np.concatenate(y)
+        l=np.concatenate(l)
+        v=np.concatenate(v)
+
+        # scale the value, which at this time is
+        # only accounting for the relative pixel area
+        # 1. direct image weight (wd),
+        # 2. ratio of pixel areas between seg & FLT
+        # 3. wavelength sampling (trapezoidal rule)
+        v=v*(pixrat*dwav)*src.wht[pix]
+
+        # split into a table for each direct-image pixel
+        ptr=np.flatnonzero(np.diff(pix))+1
+        ptr=np.concatenate(([0],ptr,[len(pix)]))
+        for i0,i1 in zip(ptr[:-1],ptr[1:]):
             
-            # drizzle these corners
-            x,y,l,v=beamconf.drizzle(xg,yg,wav,pixfrac=pixfrac,
-                                     band=self.filtname)
-
-            if len(x)!=0:
-                # define the pixel coordinate
-                pix=(int(xd-src.ltv[0]),int(yd-src.ltv[1]))
-                # scale the value, which at this time is
-                # only accounting for the relative pixel area
-                # 1. direct image weight (wd),
-                # 2. ratio of pixel areas between seg & FLT
-                # 3. wavelength sampling (trapezoidal rule)
-                #v*=(pixrat*dwav)
-                
-                # create the table
-                pdt=h5table.PDT(pix,x,y,l,v*pixrat*dwav*wd)
+            # define the pixel coordinate
+            i=pix[i0]
+            pixel=(int(src.xd[i]-src.ltv[0]),int(src.yd[i]-src.ltv[1]))
 
+            # create the table
+            pdt=h5table.PDT(pixel,x[i0:i1],y[i0:i1],l[i0:i1],v[i0:i1])
 
-                # apply a convolution kernel if present
-                #if isinstance(kernel,Kernel):
-                if kernel is not None:
-                    #print('before: {}'.format(len(pdt)))
-                    pdt.convolve2(kernel,device)
-                    #print('after: {}\n'.format(len(pdt)))
+            # apply a convolution kernel if present
+            if kernel is not None:
+                pdt.convolve2(kernel,device)
                     
-                # maybe apply a convolution kernel
-                #if isinstance(sigma,(float,int)):
-                #    # ok... so this should implement a basic Gaussian
-                #    # kernel that does not vary with wavelength or
-                #    # with detector (or detector position).  The next
-                #    # step would be to get ```device``` and
-                #    # ```beamconf``` to work together
-                #    # to build the Kernel.  ```beamconf``` should record
-                #    # aspects that change with dispersion order
-                #    # and ```device``` should record aspects that
-                #    # change with detector (and position).  When they
-                #    # work together, they should also return a
-                #    # ```GaussianKernel``` of the appropriate size
-                #    # (say something that is ~3x the expected sigma, here
-                #    #  I call that factor ```nsigma```.).
-                #
-                #    kerntype='square'
-                #if kerntype=='gaussian':
-                #        size=int(np.ceil(sigma*nsigma))
-                #        if size %2 == 0:
-                #            size+=1
-                #        if size>1:
-                #            kern = kernel.GaussianKernel(sigma,size)
-                #            pdt.convolve(kern,device)
-                #    elif kerntype=='square':
-                #        kern = kernel.SquareKernel(sigma)
-                #        pdt.convolve(kern,device)
-                #    else:
-                #        pass
-
-                
-                # save to the table
-                pdts.append(pdt)
-        return pdts
+            # maybe apply a convolution kernel
+            #if isinstance(sigma,(float,int)):
+            #    # ok... so this should implement a basic Gaussian
+            #    # kernel that does not vary with wavelength or
+            #    # with detector (or detector position).  The next
+            #    # step would be to get ```device``` and
+            #    # ```beamconf``` to work together
+            #    # to build the Kernel.  ```beamconf``` should record
+            #    # aspects that change with dispersion order
+            #    # and ```device``` should record aspects that
+            #    # change with detector (and position).  When they
+            #    # work together, they should also return a
+            #    # ```GaussianKernel``` of the appropriate size
+            #    # (say something that is ~3x the expected sigma, here
+            #    #  I call that factor ```nsigma```.).
+            #
+            #    kerntype='square'
+            #if kerntype=='gaussian':
+            #        size=int(np.ceil(sigma*nsigma))
+            #        if size %2 == 0:
+            #            size+=1
+            #        if size>1:
+            #            kern = kernel.GaussianKernel(sigma,size)
+            #            pdt.convolve(kern,device)
+            #    elif kerntype=='square':
+            #        kern = kernel.SquareKernel(sigma)
+            #        pdt.convolve(kern,device)
+            #    else:
+            #        pass
+
+            # save to the table
+            yield pdt
 
     def make_omts(self,src,wav,beamconf,device,pixfrac=1.):
 
@@ -146,117 +166,212 @@ class Tabulate(object):
         return [omt]
 
     
-    def make_table(self,grism,sources,beam,**kwargs):
-        pixfrac=1.0    # DO NOT CHANGE THIS VALUE
-        dataset=grism.dataset
-
-
-        
-        # skip if not remaking
-        if not self.remake:
-            return
-
+    def table_key(self,device,beamconf,wav,kernel=None,**kwargs):
+        ''' hash the inputs to the tables that are common to all sources '''
+
+        sha=hashlib.sha1()
+        sha.update(str((self.ttype,self.nsub,beamconf.beam,
+                        self.filtname)).encode())
+        sha.update(np.asarray(wav,dtype=np.float64).tobytes())
+        sha.update(device.to_header_string().encode())
+
+        # the grism configuration file
+        sha.update(file_hash(beamconf.conffile).encode())
+
+        # the convolution kernel
+        if kernel is not None:
+            sha.update(kernel.fingerprint().encode())
+        return sha.hexdigest()
         
+    def fingerprint(self,src,key):
+        ''' hash the inputs to the tables for a single source '''
+
+        sha=hashlib.sha1(key.encode())
+        sha.update(np.asarray(src.xd,dtype=np.int64).tobytes())
+        sha.update(np.asarray(src.yd,dtype=np.int64).tobytes())
+        sha.update(np.asarray(src.wht,dtype=np.float64).tobytes())
+        sha.update(src.to_header_string().encode())
+        return sha.hexdigest()
+    
+    @property
+    def tabfunc(self):
         ttype=self.ttype.lower()
         if ttype=='pdt':
-            tabfunc=self.make_pdts
+            return self.make_pdts
         elif ttype=='omt':
-            tabfunc=self.make_omts
+            return self.make_omts
         else:
-            print('[warn]The table type does not exist.')
-            return
-
-        with h5table.H5Table(dataset,path=self.path) as h5:
-            tabname=h5.filename
-
-            # process each device in the grism image
-            for device in grism:
-                
+            return None
 
-                # figure out which sourcs to do
-                #if self.remake:
-                #    sources_done=[]
-                #else:
-                #    sources_done=list(device.keys())
+    def make_units(self,h5,grism,sources,beam,**kwargs):
+        ''' prepare the tables for a grism and split the work into units '''
 
-                    
-                # load the config file
-                beamconf=device.load_beam(beam)
+        units,fingerprints=[],{}
+        
+        # process each device in the grism image
+        for device in grism:
+            
+            # load the config file
+            beamconf=device.load_beam(beam)
 
                                 
-                # get the center of the device
-                xc,yc=device.naxis1/2.,device.naxis2/2.
-
-                # get the ODT wavelenegths.  NOTE: This are *NOT* the
-                # same as the extraction wavelengths due to NSUB.
-                # here using center of device.  Could improve this by
-                # putting inside loop on sources and take (xc,yc)
-                # from the source.  This is just faster and doesn't
-                # seem to be a problem just yet
-                #wav=beamconf.wavelengths(xc,yc,self.nsub)  
-                #dwav=wav[1]-wav[0]
-
-                # ok, now try using the default values of the extraction
-                # from the XML file.
-                dwav=device.defaults['dlamb']/self.nsub
-                wav=np.arange(device.defaults['lamb0'],
-                              device.defaults['lamb1']+dwav,dwav)
-
-                # add some stuff ot the table
-                #devtab.add_attribute('nsource',np.uint32(len(sources)))
-                #devtab.add_attribute('wav0',np.float32(wav[0]))
-                #devtab.add_attribute('wav1',np.float32(wav[-1]))
-                #devtab.add_attribute('dwav',np.float32(dwav))
-
-
-                # create a group for the device
-                h5.add_device(device)
-
-                # create beam for the data
-                h5.add_beam(beam)
-
-                # create a table-type for the data
-                h5.add_ttype(self.ttype,wav0=wav[0],wav1=wav[-1],dwav=dwav)
+            # get the center of the device
+            xc,yc=device.naxis1/2.,device.naxis2/2.
+
+            # get the ODT wavelenegths.  NOTE: This are *NOT* the
+            # same as the extraction wavelengths due to NSUB.
+            # here using center of device.  Could improve this by
+            # putting inside loop on sources and take (xc,yc)
+            # from the source.  This is just faster and doesn't
+            # seem to be a problem just yet
+            #wav=beamconf.wavelengths(xc,yc,self.nsub)  
+            #dwav=wav[1]-wav[0]
+
+            # ok, now try using the default values of the extraction
+            # from the XML file.
+            dwav=device.defaults['dlamb']/self.nsub
+            wav=np.arange(device.defaults['lamb0'],
+                          device.defaults['lamb1']+dwav,dwav)
+
+            # create a group for the device
+            h5.add_device(device)
+
+            # create beam for the data
+            h5.add_beam(beam)
+
+            # create a table-type for the data
+            h5.add_ttype(self.ttype,wav0=wav[0],wav1=wav[-1],dwav=dwav)
+
+            # load the fingerprints of the tables already present
+            if self.remake:
+                if self.ttype=='pdt':
+                    h5.clear_pdts()
+                fingerprints[device.name]={}
+            else:
+                fingerprints[device.name]=h5.load_fingerprints()
+            key=self.table_key(device,beamconf,wav,**kwargs)
+
+            # find the sources whose inputs have changed (or are missing)
+            todo=[]
+            for src in sources:
+                fingerprint=self.fingerprint(src,key)
+                if self.remake or \
+                   fingerprints[device.name].get(src.segid)!=fingerprint:
+                    todo.append((src,fingerprint))
+
+            # split the sources into chunks
+            if self.chunksize is None:
+                ncpu=max(self.ncpu,1) if self.ncpu else os.cpu_count()
+                chunksize=int(np.ceil(len(todo)/(4.*ncpu)))
+            else:
+                chunksize=self.chunksize
+            chunksize=max(chunksize,1)
+            for i in range(0,len(todo),chunksize):
+                units.append((grism.dataset,device,wav,todo[i:i+chunksize]))
                 
+        return units,fingerprints
+
+    def make_unit(self,unit,beam,**kwargs):
+        ''' make the tables for a (grism,device,source-chunk) unit '''
+
+        dataset,device,wav,todo=unit
+
+        # load the config file
+        beamconf=device.load_beam(beam)
+
+        # make the tables in memory
+        tables=[]
+        for src,fingerprint in todo:
+            tabs=list(self.tabfunc(src,wav,beamconf,device,**kwargs))
+            tables.append((src.segid,fingerprint,tabs))
+        return dataset,device.name,tables
+
+    def write_unit(self,h5,result,beam,fingerprints):
+        ''' write the tables from a unit, as the single writer of a file '''
+
+        dataset,devname,tables=result
+        h5.open_table(devname,beam,self.ttype)
+        for segid,fingerprint,tabs in tables:
+            if self.ttype=='pdt':
+                # write all the pixels of a source at once
+                h5.write_pdts(segid,tabs)
+            else:
+                for tab in tabs:
+                    h5.write_in_file(tab)
                 
-                # ------ ABOVE IS GENERAL TABLE  -------
-                # ------ BELOW IS FOR MAKING ODT -------
-
+                    # compute the vertices in an Object Vertices Table
+                    #ovt=tab.compute_vertices()                        
+                    #h5.write_in_file(ovt)
+            fingerprints[devname][segid]=fingerprint
+            
+    def write_fingerprints(self,h5,beam,fingerprints):
+        ''' record the fingerprints of the tables for each device '''
+        
+        for devname,fps in fingerprints.items():
+            h5.open_table(devname,beam,self.ttype)
+            h5.write_fingerprints(fps)
+        
+    def make_table(self,grism,sources,beam,**kwargs):
+        pixfrac=1.0    # DO NOT CHANGE THIS VALUE
+        dataset=grism.dataset
 
-                # get the detector pixel area
-                #devpix_area=device.pixelarea
+        if self.tabfunc is None:
+            print('[warn]The table type does not exist.')
+            return
 
-                
-                # process each source
-                for src in sources:
-                    #if src.name not in sources_done:  #
+        with h5table.H5Table(dataset,path=self.path) as h5:
+            tabname=h5.filename
 
-                    
-                    # make the table
-                    #tab=self.make_odt(src,wav,beamconf,device)
-                    tabs=tabfunc(src,wav,beamconf,device,**kwargs)
-                    for tab in tabs:
-                        h5.write_in_file(tab)
-                        
+            # process each unit serially
+            units,fingerprints=self.make_units(h5,grism,sources,beam,**kwargs)
+            for unit in units:
+                result=self.make_unit(unit,beam,**kwargs)
+                self.write_unit(h5,result,beam,fingerprints)
+            self.write_fingerprints(h5,beam,fingerprints)
 
-                        
-                        # compute the vertices in an Object Vertices Table
-                        #ovt=tab.compute_vertices()                        
-                        #h5.write_in_file(ovt)
+        # remove the tables that were replaced
+        h5.compact()
                         
         return tabname
 
     def run(self,grisms,sources,beam,**kwargs):
         self.filtname=sources.obscat.detband.name
-                
-        # create a pool
-        pool=Pool(self.make_table,ncpu=self.ncpu,desc="Making tables")
 
-        # run the pool
-        tabnames=pool(grisms.values(),sources,beam,**kwargs)
+        if self.tabfunc is None:
+            print('[warn]The table type does not exist.')
+            return
 
+        # open each table file, which is only written by this process
+        tables,units,fingerprints={},[],{}
+        for grism in grisms.values():
+            h5=h5table.H5Table(grism.dataset,path=self.path).__enter__()
+            tables[grism.dataset]=h5
+            
+            # split each grism into (grism,device,source-chunk) units
+            data=self.make_units(h5,grism,sources,beam,**kwargs)
+            units.extend(data[0])
+            fingerprints[grism.dataset]=data[1]
+                
+        # create a pool, whose workers make the tables in memory
+        pool=Pool(self.make_unit,ncpu=self.ncpu,desc="Making tables")
+
+        # write the tables as the units finish
+        try:
+            for result in pool.stream(units,beam,**kwargs):
+                dataset=result[0]
+                self.write_unit(tables[dataset],result,beam,
+                                fingerprints[dataset])
+        finally:
+            for dataset,h5 in tables.items():
+                self.write_fingerprints(h5,beam,fingerprints[dataset])
+                h5.__exit__(None,None,None)
+
+        # remove the tables that were replaced
+        for h5 in tables.values():
+            h5.compact()
+                
         # for debugging
         #tabnames=[self.make_table(grism,sources,beam) for grism in grisms]
+        tabnames=[h5.filename for h5 in tables.values()]
                 
         return tabnames
-    
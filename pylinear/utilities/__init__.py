@@ -1,5 +1,6 @@
 #from . import hdf5
 from .pool import Pool
+from .accumulator import Accumulator
 from . import gzip
 from . import ascii_files
 from . import argparse
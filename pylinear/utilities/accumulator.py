@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class Accumulator(object):
+    ''' accumulate typed columns in fixed-size chunks '''
+
+    # number of elements in a chunk
+    CHUNKSIZE=2**20
+    
+    def __init__(self,*dtypes,chunksize=None):
+        self.dtypes=dtypes
+        if chunksize is None:
+            chunksize=self.CHUNKSIZE
+        self.chunksize=max(int(chunksize),1)
+
+        self.chunks=[]     # list of filled chunks (a tuple of arrays)
+        self.n=0           # total number of elements
+        self.new_chunk()
+
+    def new_chunk(self):
+        self.current=tuple(np.empty(self.chunksize,dtype=d) for d in self.dtypes)
+        self.ncurrent=0
+        
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        ''' the memory allocated in the chunks '''
+        size=sum(np.dtype(d).itemsize for d in self.dtypes)
+        return (len(self.chunks)+1)*self.chunksize*size
+    
+    def extend(self,*arrays):
+        assert len(arrays)==len(self.dtypes),'Invalid number of columns'
+        arrays=[np.asarray(a).ravel() for a in arrays]
+        n=len(arrays[0])
+        assert all(len(a)==n for a in arrays),'Mismatched column lengths'
+
+        # copy into the chunks
+        i=0
+        while i<n:
+            m=min(n-i,self.chunksize-self.ncurrent)
+            for cur,a in zip(self.current,arrays):
+                cur[self.ncurrent:self.ncurrent+m]=a[i:i+m]
+            self.ncurrent+=m
+            i+=m
+            if self.ncurrent==self.chunksize:
+                self.chunks.append(self.current)
+                self.new_chunk()
+        self.n+=n
+        
+    def to_numpy(self):
+        ''' join the chunks, releasing each one as it is copied '''
+
+        out=tuple(np.empty(self.n,dtype=d) for d in self.dtypes)
+        chunks=self.chunks+[tuple(c[:self.ncurrent] for c in self.current)]
+        self.chunks=[]
+        self.new_chunk()
+        
+        i=0
+        while chunks:
+            chunk=chunks.pop(0)
+            m=len(chunk[0])
+            for o,c in zip(out,chunk):
+                o[i:i+m]=c
+            i+=m
+            del chunk
+        self.n=0
+        
+        if len(out)==1:
+            out=out[0]
+        return out
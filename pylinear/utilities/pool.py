@@ -69,6 +69,25 @@ class Pool(object):
             
         return results
 
+    def stream(self,itrs,*args,**kwargs):
+        ''' call the pool, but yield the results as they finish '''
+
+        total=len(itrs)    # number of iterations to do
+        if self.ncpu==1:
+            print('[info]Serial Processing')
+            for i in tqdm.tqdm(itrs,total=total,desc=self.desc):
+                yield self.func(i,*args,**kwargs)
+        else:
+            print('[info]Parallel Processing: {} processes'.format(self.ncpu))
+            func=self.func
+            self.func=partial(self.func,**kwargs)
+            try:
+                with mp.Pool(processes=self.ncpu) as p:
+                    imap=p.imap_unordered(self.__worker__,
+                                          self.__zip__(itrs,*args))
+                    yield from tqdm.tqdm(imap,total=total,desc=self.desc)
+            finally:
+                self.func=func
 
 
 if __name__=='__main__':
@@ -1,5 +1,7 @@
 import numpy as np
 import datetime
+import hashlib
+import os
 from astropy.io import fits
 from astropy.wcs import WCS as astropyWCS
 import astropy.wcs.utils as wcsutils
@@ -20,6 +22,12 @@ def formatter(func):
 class WCS(astropyWCS):
     ''' A class to override the astropy.wcs.WCS to do many more things '''
 
+    # the pixel-area maps of the detectors, keyed by their distortion
+    PAMS={}
+
+    # number of pixels to compute at once for a pixel-area map
+    PAMBLOCK=2**20
+
     
     def __init__(self,hdr):
         # ok, there is this annoying situation where the SIP coefs will
@@ -56,45 +64,97 @@ class WCS(astropyWCS):
 
             
    
-    def pixel_area_map(self,x,y,scale=1.):
-        ''' compute the pixel area for the distortion '''
+    def sip_derivatives(self):
+        ''' the coefficients of the derivatives of the SIP polynomials '''
+
+        P=np.polynomial.polynomial
+        derivs=[]
+        for name in ('a','b'):
+            coefs=getattr(self.sip,name,None) if self.sip is not None else None
+            if coefs is None:
+                coefs=np.zeros((1,1),dtype=float)
+            derivs.append(P.polyder(coefs,axis=0))   # d/dx
+            derivs.append(P.polyder(coefs,axis=1))   # d/dy
+        return derivs
+
+    def pixel_area_function(self,x,y,scale=1.):
+        ''' evaluate the pixel area for the distortion '''
         
-        dx=np.array(x)-(self.wcs.crpix[0]-1.)
-        dy=np.array(y)-(self.wcs.crpix[1]-1.)
-        if np.isscalar(x):
-            n=0
-        else:
-            n=len(x)
-
-
-        # compute derivatives for A
-        dadx=np.ones_like(dx)
-        dady=np.zeros_like(dx)
-        if hasattr(self.sip,'a'):
-            ii,jj=np.where(self.sip.a != 0)
-            for i,j,v in zip(ii,jj,self.sip.a[ii,jj]):
-                if i!=0:
-                    dadx+=(v*i*dx**(i-1)*dy**j)
-                if j!=0:
-                    dady+=(v*j*dx**i*dy**(j-1))
-                
-            
-            
+        dx=np.asarray(x,dtype=float)-(self.wcs.crpix[0]-1.)
+        dy=np.asarray(y,dtype=float)-(self.wcs.crpix[1]-1.)
+        dx,dy=np.broadcast_arrays(dx,dy)
 
-        # compute derivatives for B         
-        dbdx=np.zeros_like(dx)
-        dbdy=np.ones_like(dx)
-        if hasattr(self.sip,'b'):
-            ii,jj=np.where(self.sip.b != 0)
-            for i,j,v in zip(ii,jj,self.sip.b[ii,jj]):
-                if i!=0:
-                    dbdx+=(v*i*dx**(i-1)*dy**j)
-                if j!=0:
-                    dbdy+=(v*j*dx**i*dy**(j-1))
+        # the derivatives of the SIP polynomials by Horner's rule
+        P=np.polynomial.polynomial
+        dadx,dady,dbdx,dbdy=[P.polyval2d(dx,dy,c) for c in
+                             self.sip_derivatives()]
+        dadx+=1.
+        dbdy+=1.
 
         jacobian = scale*np.abs(dadx * dbdy - dady * dbdx)
+        return jacobian
+
+    def pixel_area_key(self,scale=1.):
+        ''' hash the inputs to the pixel-area map of the detector '''
+
+        sha=hashlib.sha1(str((self.shape,scale)).encode())
+        sha.update(np.asarray(self.wcs.crpix,dtype=float).tobytes())
+        for coefs in self.sip_derivatives():
+            sha.update(np.asarray(coefs,dtype=float).tobytes())
+        return sha.hexdigest()
+
+    def pixel_area_image(self,scale=1.,path=None):
+        ''' the pixel-area map of the full detector (cached) '''
+
+        key=self.pixel_area_key(scale=scale)
+        if key in self.PAMS:
+            return self.PAMS[key]
+
+        filename=None
+        if path is not None:
+            filename=os.path.join(path,'pam_{}.npy'.format(key))
+
+        if filename is not None and os.path.isfile(filename):
+            pam=np.load(filename,mmap_mode='r')
+        else:
+            # compute in blocks of rows to limit the temporary arrays
+            ny,nx=self.shape
+            pam=np.empty(self.shape,dtype=float)
+            x=np.arange(nx,dtype=float)
+            nrow=max(self.PAMBLOCK//max(nx,1),1)
+            for y0 in range(0,ny,nrow):
+                y=np.arange(y0,min(y0+nrow,ny),dtype=float)
+                pam[y0:y0+len(y)]=self.pixel_area_function(x[np.newaxis,:],
+                                                           y[:,np.newaxis],
+                                                           scale=scale)
+            pam.setflags(write=False)
+            
+            # save the map atomically
+            if filename is not None:
+                tmpfile='{}.{}.tmp'.format(filename,os.getpid())
+                with open(tmpfile,'wb') as fp:
+                    np.save(fp,pam)
+                os.replace(tmpfile,filename)
+
+        self.PAMS[key]=pam
+        return pam
+                
+    def pixel_area_map(self,x,y,scale=1.,path=None):
+        ''' compute the pixel area for the distortion '''
+
+        # pixels on the detector are looked up in the cached map
+        xx,yy=np.asarray(x),np.asarray(y)
+        if xx.ndim==1 and len(xx)>0 and xx.dtype.kind in 'iu' and \
+           yy.dtype.kind in 'iu' and np.amax(xx)<self.shape[1] and \
+           np.amax(yy)<self.shape[0] and np.amin(xx)>=0 and np.amin(yy)>=0:
+            pam=self.pixel_area_image(scale=scale,path=path)
+            jacobian=pam[yy,xx]
+        else:
+            jacobian=self.pixel_area_function(xx,yy,scale=scale)
         
-        if n==1:
+        if np.isscalar(x):
+            jacobian=float(jacobian)
+        elif xx.ndim==1 and len(xx)==1:
             jacobian=jacobian[0]
         
         return jacobian